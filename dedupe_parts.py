@@ -0,0 +1,151 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from PIL import Image
+
+import model_index
+
+# extract_psd.MANIFEST_NAME, not imported here to avoid pulling in psd_tools
+EXTRACT_MANIFEST_NAME = '.extract_manifest.json'
+
+def hash_image(path):
+    """Content address of a part: hash of its decoded RGBA pixels and size, independent of PNG encoding."""
+    with Image.open(path) as image:
+        image = image.convert('RGBA')
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{image.width}x{image.height}:".encode())
+        digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def iter_layers(node):
+    if node.get("type") == "layer" and node.get("image"):
+        yield node
+    for child in node.get("children", []):
+        yield from iter_layers(child)
+
+def find_characters(characters_dir):
+    return sorted(d for d in os.listdir(characters_dir)
+                  if os.path.exists(os.path.join(characters_dir, d, 'PSD', 'model.json')))
+
+class PartStore:
+    """
+    Content-addressed store: each distinct bitmap is kept once as <hash>.png under store_dir.
+    The first file seen with a given hash is copied byte-for-byte, later ones only reference it.
+    """
+    def __init__(self, store_dir, dry_run=False):
+        self.store_dir = store_dir
+        self.dry_run = dry_run
+        self.stored = set()
+
+    def add(self, source_path, content_hash):
+        """Returns (store path, bytes newly stored)."""
+        store_path = os.path.join(self.store_dir, f"{content_hash}.png")
+        if content_hash in self.stored:
+            return store_path, 0
+        self.stored.add(content_hash)
+        if not self.dry_run:
+            os.makedirs(self.store_dir, exist_ok=True)
+            shutil.copyfile(source_path, store_path)
+        return store_path, os.path.getsize(source_path)
+
+def dedupe_character(src_char_dir, dst_char_dir, store, dry_run=False):
+    """
+    Rewrite one character's model.json so layer nodes reference the store (node["hash"] plus an
+    "image" path relative to the PSD directory, as the web app resolves it), and copy the
+    character's other files. Returns the report entry.
+    """
+    src_psd_dir = os.path.join(src_char_dir, 'PSD')
+    dst_psd_dir = os.path.join(dst_char_dir, 'PSD')
+    with open(os.path.join(src_psd_dir, 'model.json'), 'r', encoding='utf-8') as f:
+        model_data = json.load(f)
+
+    entry = {"layers": 0, "unique": 0, "original_bytes": 0, "stored_bytes": 0}
+    hashes = {}     # source path -> hash, a file referenced twice is only read and counted once
+    for node in iter_layers(model_data["root"]):
+        source_path = os.path.normpath(os.path.join(src_psd_dir, node["image"]))
+        if not os.path.exists(source_path):
+            print(f"  Warning: Missing image {node['image']}")
+            continue
+        entry["layers"] += 1
+        if source_path not in hashes:
+            hashes[source_path] = hash_image(source_path)
+            entry["original_bytes"] += os.path.getsize(source_path)
+        content_hash = hashes[source_path]
+        store_path, stored_bytes = store.add(source_path, content_hash)
+        entry["stored_bytes"] += stored_bytes
+        node["hash"] = content_hash
+        node["image"] = os.path.relpath(store_path, dst_psd_dir).replace(os.sep, '/')
+    entry["unique"] = len(set(hashes.values()))
+    entry["saved_bytes"] = entry["original_bytes"] - entry["stored_bytes"]
+
+    if not dry_run:
+        os.makedirs(dst_psd_dir, exist_ok=True)
+        with open(os.path.join(dst_psd_dir, 'model.json'), 'w', encoding='utf-8') as f:
+            json.dump(model_data, f, indent=2, ensure_ascii=False)
+        # The index carries the image paths too, so it is rebuilt from the rewritten model
+        model_index.write_index(dst_psd_dir, model_data)
+        # Everything except the original parts/, model.json, its index and the extraction manifest
+        # (e.g. preview images) is copied as is
+        skipped = {'model.json', model_index.INDEX_NAME, EXTRACT_MANIFEST_NAME}
+        for dirpath, dirnames, filenames in os.walk(src_char_dir):
+            rel_dir = os.path.relpath(dirpath, src_char_dir)
+            if rel_dir == 'PSD':
+                dirnames[:] = [d for d in dirnames if d != 'parts']
+            for filename in filenames:
+                if rel_dir == 'PSD' and filename in skipped:
+                    continue
+                dst_dir = os.path.join(dst_char_dir, rel_dir)
+                os.makedirs(dst_dir, exist_ok=True)
+                shutil.copy2(os.path.join(dirpath, filename), os.path.join(dst_dir, filename))
+    return entry
+
+def print_report(report):
+    print(f"{'Character':<12}{'Layers':>8}{'Unique':>8}{'Original MB':>13}{'Stored MB':>11}{'Saved MB':>10}{'Saved':>8}")
+    for name, entry in report.items():
+        ratio = entry["saved_bytes"] / entry["original_bytes"] if entry["original_bytes"] else 0.0
+        print(f"{name:<12}{entry['layers']:>8}{entry['unique']:>8}"
+              f"{entry['original_bytes'] / (1024*1024):>13.2f}{entry['stored_bytes'] / (1024*1024):>11.2f}"
+              f"{entry['saved_bytes'] / (1024*1024):>10.2f}{ratio:>8.1%}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a deployment copy of resources/ where identical part bitmaps are stored once.")
+    parser.add_argument('-i', '--input', type=str, default='resources', help="Source resources directory")
+    parser.add_argument('-o', '--output', type=str, default='dist/resources', help="Output resources directory")
+    parser.add_argument('--per-character', action='store_true',
+                        help="Keep a separate store per character (PSD/parts/<hash>.png) instead of one shared store")
+    parser.add_argument('--report-only', action='store_true', help="Only print the report, write nothing")
+    parser.add_argument('--report', type=str, default=None, help="Also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    if os.path.abspath(args.input) == os.path.abspath(args.output):
+        parser.error("Output directory must differ from the input directory")
+
+    characters_dir = os.path.join(args.input, 'characters')
+    shared_store = PartStore(os.path.join(args.output, 'parts'), args.report_only)
+    report = {}
+    for name in find_characters(characters_dir):
+        print(f"Processing {name}...")
+        dst_char_dir = os.path.join(args.output, 'characters', name)
+        store = PartStore(os.path.join(dst_char_dir, 'PSD', 'parts'), args.report_only) if args.per_character else shared_store
+        report[name] = dedupe_character(os.path.join(characters_dir, name), dst_char_dir, store, args.report_only)
+
+    total = {key: sum(entry[key] for entry in report.values())
+             for key in ("layers", "original_bytes", "stored_bytes", "saved_bytes")}
+    total["unique"] = len(shared_store.stored) if not args.per_character else sum(entry["unique"] for entry in report.values())
+    report["Total"] = total
+    print()
+    print_report(report)
+
+    if not args.report_only:
+        char_list_path = os.path.join(args.input, 'characters.json')
+        if os.path.exists(char_list_path):
+            shutil.copy(char_list_path, os.path.join(args.output, 'characters.json'))
+        print(f"\nDeduplicated resources written to {args.output}")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,88 +1,171 @@
 import os
 import json
 import shutil
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from psd_tools import PSDImage
 from PIL import Image
 
-def ensure_unique_filename(directory, filename):
-    """Ensure filename is unique in directory by appending number."""
+import model_index
+
+MANIFEST_NAME = '.extract_manifest.json'
+MANIFEST_VERSION = 1
+
+def ensure_unique_filename(directory, filename, taken=None):
+    """
+    Ensure filename is unique in directory by appending number.
+    If taken (a set of filenames already used in this extraction) is given, check against it
+    instead of the files on disk, and record the returned name in it.
+    """
     name, ext = os.path.splitext(filename)
     counter = 1
     new_filename = filename
-    while os.path.exists(os.path.join(directory, new_filename)):
+    exists = (lambda f: f in taken) if taken is not None else (lambda f: os.path.exists(os.path.join(directory, f)))
+    while exists(new_filename):
         new_filename = f"{name}_{counter}{ext}"
         counter += 1
+    if taken is not None:
+        taken.add(new_filename)
     return new_filename
 
-def extract_layer(layer, output_dir, relative_path_prefix):
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_pixels(image):
+    """Hash of the decoded layer pixels (mode, size and raw bytes), independent of PNG encoding."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}:{image.width}x{image.height}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def load_manifest(target_root):
+    try:
+        with open(os.path.join(target_root, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {"version": MANIFEST_VERSION, "psd_hash": None, "layers": {}}
+
+def write_if_changed(path, text):
+    """Write text to path only if the content differs, so unchanged files keep their mtime."""
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            if f.read() == text:
+                return False
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return True
+
+def encode_layer(image, path, old_hash):
+    """Save image to path unless its pixels match old_hash and the file is still there. Returns (pixel_hash, written)."""
+    pixel_hash = hash_pixels(image)
+    if pixel_hash == old_hash and os.path.exists(path):
+        return pixel_hash, False
+    image.save(path)
+    return pixel_hash, True
+
+class LayerExtractor:
     """
-    Recursively extract layers.
-    Returns a dict describing the layer/group structure.
+    Walks the layer tree in document order and queues each layer's PNG encode on a thread pool.
+    Filenames are assigned while walking, so they do not depend on encode order.
     """
-    node = {
-        "name": layer.name,
-        "visible": layer.visible,
-        "opacity": layer.opacity,
-        "blend_mode": str(layer.blend_mode).replace('BlendMode.', ''),
-    }
+    def __init__(self, output_dir, relative_path_prefix, executor, old_hashes):
+        self.output_dir = output_dir
+        self.relative_path_prefix = relative_path_prefix
+        self.executor = executor
+        self.old_hashes = old_hashes
+        self.taken = set()
+        self.futures = {}   # filename -> future of encode_layer
 
-    if layer.is_group():
-        node["type"] = "group"
-        node["children"] = []
-        for child in layer:
-            child_node = extract_layer(child, output_dir, relative_path_prefix)
-            if child_node:
-                node["children"].append(child_node)
-        # If group is empty, might return None or keep empty? Keeping empty group for structure.
-        return node
-    else:
-        # It's a layer
-        if layer.width == 0 or layer.height == 0:
-            return None # Skip empty layers
-
-        node["type"] = "layer"
-        node["clipping"] = bool(getattr(layer, "clipping", False))
-        
-        # Save image (use topil to keep pixels even if layer.visible=False)
-        image = layer.topil()
-        bbox = layer.bbox # (left, top, right, bottom)
-        
-        if image:
-            # Crop to bbox is automatic by layer.composite() usually returning the layer image at its size
-            # BUT layer.composite() returns an image the size of the PSD canvas? No, layer.composite() returns cropped image.
-            # Let's verify bbox. layer.bbox is relative to canvas.
-            
-            # Construct filename
-            safe_name = "".join([c if c.isalnum() or c in ('_', '-') else '_' for c in layer.name])
-            filename = f"{safe_name}.png"
-            filename = ensure_unique_filename(output_dir, filename)
-            
-            image.save(os.path.join(output_dir, filename))
-            
-            node["image"] = os.path.join(relative_path_prefix, filename)
-            node["offset"] = {"x": bbox[0], "y": bbox[1]}
-            node["size"] = {"width": bbox[2]-bbox[0], "height": bbox[3]-bbox[1]}
-            
+    def extract_layer(self, layer):
+        """
+        Recursively extract layers.
+        Returns a dict describing the layer/group structure.
+        """
+        node = {
+            "name": layer.name,
+            "visible": layer.visible,
+            "opacity": layer.opacity,
+            "blend_mode": str(layer.blend_mode).replace('BlendMode.', ''),
+        }
+
+        if layer.is_group():
+            node["type"] = "group"
+            node["children"] = []
+            for child in layer:
+                child_node = self.extract_layer(child)
+                if child_node:
+                    node["children"].append(child_node)
+            # If group is empty, might return None or keep empty? Keeping empty group for structure.
             return node
         else:
-            return None
+            # It's a layer
+            if layer.width == 0 or layer.height == 0:
+                return None # Skip empty layers
+
+            node["type"] = "layer"
+            node["clipping"] = bool(getattr(layer, "clipping", False))
+
+            # Decode here (psd_tools objects are not shared across threads), encode on the pool
+            # (use topil to keep pixels even if layer.visible=False)
+            image = layer.topil()
+            bbox = layer.bbox # (left, top, right, bottom)
 
-def process_psd(psd_path):
+            if image:
+                # Construct filename
+                safe_name = "".join([c if c.isalnum() or c in ('_', '-') else '_' for c in layer.name])
+                filename = f"{safe_name}.png"
+                filename = ensure_unique_filename(self.output_dir, filename, self.taken)
+
+                self.futures[filename] = self.executor.submit(
+                    encode_layer, image, os.path.join(self.output_dir, filename), self.old_hashes.get(filename))
+
+                node["image"] = os.path.join(self.relative_path_prefix, filename)
+                node["offset"] = {"x": bbox[0], "y": bbox[1]}
+                node["size"] = {"width": bbox[2]-bbox[0], "height": bbox[3]-bbox[1]}
+
+                return node
+            else:
+                return None
+
+def process_psd(psd_path, incremental=True, threads=4):
+    """
+    Extract one PSD into <parent>/PSD/{model.json, parts/}.
+    In incremental mode, a PSD whose content hash matches the manifest is skipped, only layers whose
+    pixel hash changed are re-encoded, layer files that no longer exist are removed, and model.json
+    is only rewritten when its content changes. Otherwise the target directory is rebuilt from scratch.
+    """
     print(f"Processing: {psd_path}")
     parent_dir = os.path.dirname(psd_path)
     base_name = os.path.splitext(os.path.basename(psd_path))[0]
-    
+
     # Target directory: parent/PSD
     target_root = os.path.join(parent_dir, 'PSD')
     parts_dir = os.path.join(target_root, 'parts')
-    
-    if os.path.exists(target_root):
+    json_path = os.path.join(target_root, 'model.json')
+
+    psd_hash = hash_file(psd_path)
+    manifest = load_manifest(target_root) if incremental else None
+    if manifest is not None and manifest["psd_hash"] == psd_hash and os.path.exists(json_path) \
+            and os.path.exists(os.path.join(target_root, model_index.INDEX_NAME)) \
+            and all(os.path.exists(os.path.join(parts_dir, f)) for f in manifest["layers"]):
+        print(f"  Unchanged, skipped: {psd_path}")
+        return
+
+    if not incremental and os.path.exists(target_root):
         print(f"  Target directory exists, cleaning: {target_root}")
         shutil.rmtree(target_root)
     os.makedirs(parts_dir, exist_ok=True)
-    
+
     psd = PSDImage.open(psd_path)
-    
+
     model_data = {
         "character": base_name,
         "canvas_size": {"width": psd.width, "height": psd.height},
@@ -91,38 +174,75 @@ def process_psd(psd_path):
             "children": []
         }
     }
-    
-    for layer in psd:
-        child_node = extract_layer(layer, parts_dir, "parts")
-        if child_node:
-            model_data["root"]["children"].append(child_node)
-            
+
+    old_hashes = manifest["layers"] if manifest is not None else {}
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        extractor = LayerExtractor(parts_dir, "parts", executor, old_hashes)
+        for layer in psd:
+            child_node = extractor.extract_layer(layer)
+            if child_node:
+                model_data["root"]["children"].append(child_node)
+        layer_hashes = {}
+        written = 0
+        for filename, future in extractor.futures.items():
+            layer_hashes[filename], changed = future.result()
+            written += changed
+
+    # Remove layer files left over from a previous extraction
+    removed = 0
+    for filename in old_hashes:
+        if filename not in layer_hashes and os.path.exists(os.path.join(parts_dir, filename)):
+            os.remove(os.path.join(parts_dir, filename))
+            removed += 1
+
     # Save model.json
-    json_path = os.path.join(target_root, 'model.json')
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(model_data, f, indent=2, ensure_ascii=False)
-        
-    print(f"  Done. Saved to {target_root}")
+    write_if_changed(json_path, json.dumps(model_data, indent=2, ensure_ascii=False))
+    model_index.write_index(target_root, model_data)
+
+    # Written last, so an interrupted extraction is redone on the next run
+    manifest = {"version": MANIFEST_VERSION, "psd_hash": psd_hash, "layers": layer_hashes}
+    with open(os.path.join(target_root, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+
+    print(f"  Done. Saved to {target_root} ({written}/{len(layer_hashes)} layers written, {removed} removed)")
 
 def main():
+    parser = argparse.ArgumentParser(description="Extract layer images and model.json from character PSD files.")
+    parser.add_argument('-i', '--input', type=str, default='asset', help="Directory searched recursively for PSD files")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="Number of PSD files processed in parallel")
+    parser.add_argument('-t', '--threads', type=int, default=4, help="Layer encode threads per PSD file")
+    parser.add_argument('-f', '--force', action='store_true', help="Clean and re-extract every PSD instead of updating incrementally")
+    args = parser.parse_args()
+
     # Find all PSD files in asset directory
-    root_dir = 'asset'
+    root_dir = args.input
     psd_files = []
     for dirpath, _, filenames in os.walk(root_dir):
         for f in filenames:
             if f.lower().endswith('.psd'):
                 psd_files.append(os.path.join(dirpath, f))
-                
+
     if not psd_files:
-        print("No PSD files found in 'asset' directory.")
+        print(f"No PSD files found in '{root_dir}' directory.")
         return
 
     print(f"Found {len(psd_files)} PSD files.")
-    for psd_file in psd_files:
-        try:
-            process_psd(psd_file)
-        except Exception as e:
-            print(f"Failed to process {psd_file}: {e}")
+    incremental = not args.force
+    if args.jobs <= 1 or len(psd_files) == 1:
+        for psd_file in psd_files:
+            try:
+                process_psd(psd_file, incremental, args.threads)
+            except Exception as e:
+                print(f"Failed to process {psd_file}: {e}")
+        return
+
+    with ProcessPoolExecutor(max_workers=min(args.jobs, len(psd_files))) as executor:
+        futures = {executor.submit(process_psd, psd_file, incremental, args.threads): psd_file for psd_file in psd_files}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to process {futures[future]}: {e}")
 
 if __name__ == "__main__":
     main()
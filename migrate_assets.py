@@ -2,6 +2,8 @@ import os
 import json
 import shutil
 
+import model_index
+
 SOURCE_DIR = "asset"
 DEST_DIR = "resources"
 
@@ -50,6 +52,10 @@ def migrate():
         # Parse model.json for images
         with open(src_model, 'r') as f:
             model_data = json.load(f)
+
+        # Flat pre-indexed copy of model.json for O(1) lookups
+        model_index.write_index(dest_model_dir, model_data)
+        total_files += 1
             
         images_to_copy = set()
         
@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+from collections import deque
+
+INDEX_NAME = 'model.index.json'
+INDEX_VERSION = 1
+
+NODE_TYPES = ['root', 'group', 'layer']
+
+def build_index(model_data):
+    """
+    Flatten a model.json tree into column arrays indexed by node id.
+    Nodes are numbered breadth-first (the root is 0), so the children of every node occupy the
+    contiguous id range [child_start, child_start + child_count) in document order, bottom to top.
+    clip_base is the id of the sibling a clipping node is clipped to (the nearest non-clipping node
+    below it in the same parent, layer or group), -1 otherwise.
+    draw_order lists layer ids in paint order (depth-first, bottom to top).
+    """
+    columns = {key: [] for key in ('name', 'type', 'parent', 'depth', 'child_start', 'child_count',
+                                   'visible', 'opacity', 'blend_mode', 'clipping', 'clip_base',
+                                   'image', 'x', 'y', 'width', 'height')}
+    blend_modes = []
+    names = {}
+
+    nodes = []
+    queue = deque([(model_data["root"], -1, 0)])
+    while queue:
+        node, parent, depth = queue.popleft()
+        index = len(nodes)
+        nodes.append(node)
+        columns["name"].append(node.get("name", ""))
+        columns["type"].append(NODE_TYPES.index(node["type"]))
+        columns["parent"].append(parent)
+        columns["depth"].append(depth)
+        columns["visible"].append(int(node.get("visible", True)))
+        columns["opacity"].append(node.get("opacity", 255))
+        blend_mode = node.get("blend_mode", "NORMAL")
+        if blend_mode not in blend_modes:
+            blend_modes.append(blend_mode)
+        columns["blend_mode"].append(blend_modes.index(blend_mode))
+        columns["clipping"].append(int(node.get("clipping", False)))
+        columns["image"].append(node.get("image"))
+        offset = node.get("offset", {})
+        size = node.get("size", {})
+        columns["x"].append(offset.get("x", 0))
+        columns["y"].append(offset.get("y", 0))
+        columns["width"].append(size.get("width", 0))
+        columns["height"].append(size.get("height", 0))
+        if "name" in node:
+            names.setdefault(node["name"], []).append(index)
+
+        children = node.get("children", [])
+        # Ids of the children are those queued so far plus one for each node still ahead of them
+        columns["child_start"].append(index + len(queue) + 1 if children else -1)
+        columns["child_count"].append(len(children))
+        for child in children:
+            queue.append((child, index, depth + 1))
+
+    columns["clip_base"] = [-1] * len(nodes)
+    for index in range(len(nodes)):
+        base = -1
+        for child in range(columns["child_start"][index], columns["child_start"][index] + columns["child_count"][index]):
+            if columns["clipping"][child]:
+                columns["clip_base"][child] = base
+            else:
+                base = child
+
+    draw_order = []
+    stack = [0]
+    while stack:
+        index = stack.pop()
+        if NODE_TYPES[columns["type"][index]] == 'layer':
+            draw_order.append(index)
+        start = columns["child_start"][index]
+        stack.extend(reversed(range(start, start + columns["child_count"][index])))
+
+    return {
+        "version": INDEX_VERSION,
+        "character": model_data.get("character"),
+        "canvas_size": model_data.get("canvas_size"),
+        "count": len(nodes),
+        "node_types": NODE_TYPES,
+        "blend_modes": blend_modes,
+        "nodes": columns,
+        "names": names,
+        "draw_order": draw_order,
+    }
+
+def dumps_index(index):
+    return json.dumps(index, ensure_ascii=False, separators=(',', ':'))
+
+def write_index(target_root, model_data):
+    """Write <target_root>/model.index.json next to model.json; unchanged content is not rewritten. Returns the path."""
+    path = os.path.join(target_root, INDEX_NAME)
+    text = dumps_index(build_index(model_data))
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            if f.read() == text:
+                return path
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return path
+
+def main():
+    # Usage: python model_index.py [characters_dir]
+    characters_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join('resources', 'characters')
+    for name in sorted(os.listdir(characters_dir)):
+        target_root = os.path.join(characters_dir, name, 'PSD')
+        model_path = os.path.join(target_root, 'model.json')
+        if not os.path.exists(model_path):
+            continue
+        with open(model_path, 'r', encoding='utf-8') as f:
+            model_data = json.load(f)
+        path = write_index(target_root, model_data)
+        print(f"{name}: {os.path.getsize(model_path)} -> {os.path.getsize(path)} bytes, saved to {path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,27 @@
 import os
 import argparse
 import yaml
+import numpy as np
 from PIL import Image
 import re
 import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import repeat
 # import time
 
 import breakup
 import blend
 import ptimer
-import run
 import objtree
 import expstruct
+import charcache
+import imgwriter
+import spriteidx
 
 image_cropper = None    # For performance reason, use a global static instance of ImageCropper
+sprite_index = None     # Likewise, sprite rects are indexed once per export directory
 
 def get_blend_mode(guid: str, material: dict):
     material_name: str = material[guid]
@@ -39,141 +47,213 @@ def get_mask_key(guid: str, material: dict) -> tuple[str|None, str|None]:
     else:
         return None, None
 
-def composite_sprites(composition_node_list: list[str], node_map: dict, export_struct: expstruct.ExportStructure):
-    transform_list = []
-    size_list = []
-    # 调整位置到左上角为锚点，Unity坐标系，pixel单位
-    for node_id in composition_node_list:
-        node = node_map[node_id]
-        transform = node.get_global_transform(node_map)
-        size = node.get_sprite_size()
-        transform_list.append({
-            'x': (transform['x'] - size['x'] / 2) * 100, 
-            'y': (transform['y'] + size['y'] / 2) * 100})
-        size_list.append({
-            'x': size['x'] * 100, 
-            'y': size['y'] * 100})
-        
-    min_x = min([t['x'] for t in transform_list])
-    max_x = max([t['x'] + s['x'] for t, s in zip(transform_list, size_list)])
-    min_y = min([t['y'] - s['y'] for t, s in zip(transform_list, size_list)])
-    max_y = max([t['y'] for t in transform_list])
+@dataclass(frozen=True)
+class LayerOp:
+    """一次图层混合：组件、画布位置（左上角坐标系）与混合方式"""
+    node_id: str
+    name: str
+    position: tuple
+    blend_mode: blend.BlendMode
+    set_mask_key: str|None
+    apply_mask_key: str|None
+
+@dataclass(frozen=True)
+class FigurePlan:
+    width: int
+    height: int
+    layers: tuple   # tuple[LayerOp]，按混合顺序
+
+def _layer_extents(composition_node_list: list[int], tree: objtree.FlatTree):
+    """返回各组件左上角锚点的位置与尺寸，均为 (n, 2) 数组，Unity坐标系，pixel单位"""
+    nodes = np.asarray(composition_node_list, dtype=np.intp)
+    position = tree.global_position[nodes]
+    size = tree.sprite_size[nodes]
+    # 调整位置到左上角为锚点
+    top_left = np.column_stack(((position[:, 0] - size[:, 0] / 2) * 100,
+                                (position[:, 1] + size[:, 1] / 2) * 100))
+    return top_left, size * 100
+
+def _extents_bounds(top_left: np.ndarray, size: np.ndarray) -> tuple:
+    min_x = float(top_left[:, 0].min())
+    max_x = float((top_left[:, 0] + size[:, 0]).max())
+    min_y = float((top_left[:, 1] - size[:, 1]).min())
+    max_y = float(top_left[:, 1].max())
+    return min_x, max_x, min_y, max_y
+
+def get_canvas_bounds(composition_node_list: list[int], tree: objtree.FlatTree) -> tuple:
+    """组件并集的包围盒 (min_x, max_x, min_y, max_y)，Unity坐标系，pixel单位"""
+    return _extents_bounds(*_layer_extents(composition_node_list, tree))
+
+def plan_layers(composition_node_list: list[int], tree: objtree.FlatTree, export_struct: expstruct.ExportStructure, bounds: tuple=None) -> FigurePlan:
+    """composition_node_list: 按混合顺序的节点下标；bounds: 指定画布包围盒（见get_canvas_bounds），默认取本组组件的包围盒"""
+    top_left, size = _layer_extents(composition_node_list, tree)
+    if bounds is None:
+        bounds = _extents_bounds(top_left, size)
+    min_x, max_x, min_y, max_y = bounds
     canvas_width = int(max_x - min_x) + 1   # 防止canvas尺寸因舍入误差，小于组件尺寸
     canvas_height = int(max_y - min_y) + 1
     offset_x = min_x
     offset_y = min_y
 
     # 计算每个组件在画布上的位置，左上角坐标系
-    canvas_positions = []
-    for transform, size in zip(transform_list, size_list):
-        canvas_x = int(transform['x'] - offset_x)
-        canvas_y = int(canvas_height - (transform['y'] - offset_y))
-        canvas_positions.append((canvas_x, canvas_y))
-
-    image_blender = blend.ImageBlender(canvas_width, canvas_height)
-    for node_id, pos in zip(composition_node_list, canvas_positions):
-        node = node_map[node_id]
-
-        # 裁剪组件图像
-        sprite_path = export_struct.sprite_path[node.name]
-        m_rect = breakup.get_rect(sprite_path)
-        cropped_img = image_cropper.crop(m_rect)  
+    layers = []
+    for node, (x, y) in zip(composition_node_list, top_left.tolist()):
+        canvas_x = int(x - offset_x)
+        canvas_y = int(canvas_height - (y - offset_y))
 
         # 获取混合模式和遮罩信息
-        material_guid = node.get_material_guid()
+        material_guid = tree.material_guid(node)
         blend_mode = get_blend_mode(material_guid, export_struct.material)
         set_mask_key, apply_mask_key = get_mask_key(material_guid, export_struct.material)
+        layers.append(LayerOp(tree.ids[node], tree.names[node], (canvas_x, canvas_y), blend_mode, set_mask_key, apply_mask_key))
 
-        # 图层混合
-        print(f"Compositing node: {node.name} (id: {node.id}), blend mode: {blend_mode}, set_mask_key: {set_mask_key}, apply_mask_key: {apply_mask_key}")
-        image_blender.blend(cropped_img, pos, mode=blend_mode, set_mask_key=set_mask_key, apply_mask_key=apply_mask_key)
-
-    return image_blender.image()
+    return FigurePlan(canvas_width, canvas_height, tuple(layers))
 
-def traverse_objtree(node: objtree.Node, node_map: dict, action_list, include_only=False):
-    result = []
-    action = action_list.get(node.name, None)
-    if action is not None:
-        if action == '-':   
-            # Exclude
-            return result
-        elif action == '+': 
-            # Include
-            if node.has_sprite():
-                result.append(node.id)
-            pass
-        else:   
-            # Exclusive '>' action
-            for child_id in node.children:
-                child_node = node_map.get(child_id)
-                if child_node.name == action:
-                    assert child_node.has_sprite(), f"Child node {child_node.name} does not have a sprite"
-                    result.append(child_id)
-                    return result
-    elif node.has_sprite() and node.render_enabled() and not include_only:
-        result.append(node.id)
-
-    for child_id in node.children:
-        child_node = node_map.get(child_id)
-        result.extend(traverse_objtree(child_node, node_map, action_list, include_only))
-
-    return result
+def blend_layers(image_blender: blend.ImageBlender, layers, cropper: breakup.ImageCropper=None, index: spriteidx.SpriteIndex=None):
+    """cropper/index: 指定纹理与Sprite索引（同一进程内合成多个角色时），默认使用模块级的image_cropper/sprite_index"""
+    cropper = cropper or image_cropper
+    index = index or sprite_index
+    for layer in layers:
+        # 裁剪组件图像
+        with ptimer.span('crop'):
+            m_rect = index.get_rect(layer.name)
+            cropped_img = cropper.crop(m_rect)
 
-def parse_composition(composition_map: dict, composition_keys: list[str], objtree_root: objtree.Node, node_map: dict):
-    # 构建composition_map字典
-    composition_map_dict = { item['Key']: item['Composition'] for item in composition_map if 'Key' in item and 'Composition' in item }
+        # 图层混合
+        if ptimer.verbosity >= 2:
+            print(f"Compositing node: {layer.name} (id: {layer.node_id}), blend mode: {layer.blend_mode}, set_mask_key: {layer.set_mask_key}, apply_mask_key: {layer.apply_mask_key}")
+        with ptimer.span(f'blend.{layer.blend_mode.name}'):
+            image_blender.blend(cropped_img, layer.position, mode=layer.blend_mode, set_mask_key=layer.set_mask_key, apply_mask_key=layer.apply_mask_key)
+        ptimer.count('pixels_blended', cropped_img.width * cropped_img.height)
+
+def composite_sprites(composition_node_list: list[int], tree: objtree.FlatTree, export_struct: expstruct.ExportStructure, engine: blend.BlendEngine=blend.BlendEngine.FLOAT32):
+    plan = plan_layers(composition_node_list, tree, export_struct)
+    image_blender = blend.ImageBlender(plan.width, plan.height, engine=engine)
+    blend_layers(image_blender, plan.layers)
+    return image_blender.image()
 
-    # 展开composition_keys列表
-    composition_list = composition_keys.copy()
-    index = 0
-    while index < len(composition_list):
-        key = composition_list[index]
-        if key not in composition_map_dict:
-            # 达成终结符
-            index += 1
+def traverse_objtree(tree: objtree.FlatTree, action_list, include_only=False) -> list[int]:
+    """按先序返回要合成的节点下标（见objtree.FlatTree.traverse）"""
+    return tree.traverse(action_list, include_only)
+
+def parse_composition_item(item: str) -> tuple[str, str]:
+    """解析一个终结的composition项为 (节点名, 动作)，动作为'+'、'-'或'>'后的子节点名"""
+    if item.find('>') != -1:
+        key = item.split('>')[0]
+        action = item.split('>')[1]
+        # print(f"Exclusive action detected: {item}, key: {key}, action: {action}")
+    elif item.find('+') != -1:
+        # assert item.endswith('+'), f"Invalid composition item with +: {item}"
+        if not item.endswith('+'):
+            key = item.replace('+', '/')
+            action = '+'
         else:
-            value = composition_map_dict[key]
-            value_list = value.split(',')
-
-            new_composition_list = []
-            new_composition_list.extend(composition_list[:index])
-            new_composition_list.extend(value_list)
-            new_composition_list.extend(composition_list[index + 1:])
-            composition_list = new_composition_list
-
-    # print(f"Expanded Composition List: {composition_list}")
-
-    # 解析每个composition_list项的动作
-    action_list = {}
-    for item in composition_list:
-        if item.find('>') != -1:
-            key = item.split('>')[0]
-            action = item.split('>')[1]
-            # print(f"Exclusive action detected: {item}, key: {key}, action: {action}")
-        elif item.find('+') != -1:
-            # assert item.endswith('+'), f"Invalid composition item with +: {item}"
-            if not item.endswith('+'):
-                key = item.replace('+', '/')
-                action = '+'
+            key = item.split('+')[0]
+            action = '+'
+        # print(f"Include action detected: {item}, key: {key}, action: {action}")
+    elif item.find('-') != -1:
+        assert item.endswith('-'), f"Invalid composition item with -: {item}"
+        key = item.split('-')[0]
+        action = '-'
+        # print(f"Exclude action detected: {item}, key: {key}, action: {action}")
+    else:
+        print(f"\033[33mWarning: Composition item without action, defaulting to include: {item}\033[0m")
+        key = item
+        action = '+'
+    key = key.split('/')[-1]
+    assert key != '', f"Empty key parsed from item: {item}"
+    return key, action
+
+DEFAULT_COMPOSITION_CACHE_SIZE = 256
+
+class CompositionTable:
+    """
+    编译后的compositionMap：每个键展开到终结项后合并为 {节点名: 动作} 的闭包，首次用到时计算并保存，
+    终结项的解析结果同样只计算一次；一组composition_keys的动作即各项闭包按顺序合并（后者覆盖前者），
+    其节点列表另有LRU缓存。compositionMap中的循环引用会抛出ValueError
+    """
+    def __init__(self, composition_map: list, tree: objtree.FlatTree=None, cache_size: int=DEFAULT_COMPOSITION_CACHE_SIZE):
+        self.expansions = { item['Key']: item['Composition'].split(',') for item in composition_map if 'Key' in item and 'Composition' in item }
+        self.tree = tree
+        self.cache_size = cache_size
+        self._closures = {}             # 键或终结项 -> {节点名: 动作}
+        self._node_lists = OrderedDict()  # tuple(composition_keys) -> tuple[节点下标]，LRU顺序
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_node_lists'] = OrderedDict()
+        return state
+
+    def closure(self, item: str) -> dict:
+        if item in self._closures:
+            return self._closures[item]
+        if item not in self.expansions:
+            # 达成终结符
+            key, action = parse_composition_item(item)
+            self._closures[item] = {key: action}
+            return self._closures[item]
+
+        # 对未计算闭包的键做迭代的后序遍历，路径上重复出现的键即循环引用
+        path = [item]
+        stack = [(item, iter(self.expansions[item]))]
+        while stack:
+            key, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                closure = {}
+                for value in self.expansions[key]:
+                    closure.update(self._closures[value])
+                self._closures[key] = closure
+                stack.pop()
+                path.pop()
+            elif child in self._closures:
+                continue
+            elif child in self.expansions:
+                if child in path:
+                    cycle = ' -> '.join(path[path.index(child):] + [child])
+                    raise ValueError(f"Cyclic compositionMap reference: {cycle}")
+                path.append(child)
+                stack.append((child, iter(self.expansions[child])))
             else:
-                key = item.split('+')[0]
-                action = '+'
-            # print(f"Include action detected: {item}, key: {key}, action: {action}")
-        elif item.find('-') != -1:
-            assert item.endswith('-'), f"Invalid composition item with -: {item}"
-            key = item.split('-')[0]
-            action = '-'
-            # print(f"Exclude action detected: {item}, key: {key}, action: {action}")
+                self.closure(child)
+        return self._closures[item]
+
+    def compile(self):
+        """预先计算全部键的闭包（同时检查循环引用）"""
+        for key in self.expansions:
+            self.closure(key)
+        return self
+
+    def actions(self, composition_keys: list[str]) -> dict:
+        action_list = {}
+        for key in composition_keys:
+            action_list.update(self.closure(key))
+        return action_list
+
+    def normalized_actions(self, composition_keys: list[str]) -> tuple:
+        """{节点名: 动作}与书写顺序无关地决定合成结果，排序为元组后用作规划与缓存的键"""
+        return tuple(sorted(self.actions(composition_keys).items()))
+
+    def resolve(self, composition_keys: list[str]) -> list[int]:
+        """composition_keys对应的节点下标（先序，见objtree.FlatTree.traverse），返回新列表"""
+        cache_key = tuple(composition_keys)
+        node_list = self._node_lists.get(cache_key)
+        if node_list is None:
+            node_list = tuple(traverse_objtree(self.tree, self.actions(composition_keys)))
+            self._node_lists[cache_key] = node_list
+            if len(self._node_lists) > self.cache_size:
+                self._node_lists.popitem(last=False)
         else:
-            print(f"\033[33mWarning: Composition item without action, defaulting to include: {item}\033[0m")
-            key = item
-            action = '+'
-        key = key.split('/')[-1]
-        assert key != '', f"Empty key parsed from item: {item}"
-        action_list[key] = action
+            self._node_lists.move_to_end(cache_key)
+        return list(node_list)
 
-    # print(f"Action List: {action_list}")
-    return traverse_objtree(objtree_root, node_map, action_list)
+def parse_composition_actions(composition_map: dict, composition_keys: list[str]) -> dict:
+    """展开composition_keys并解析为 {节点名: 动作} 字典，动作为'+'、'-'或'>'后的子节点名"""
+    return CompositionTable(composition_map).actions(composition_keys)
+
+def parse_composition(composition_map: dict, composition_keys: list[str], tree: objtree.FlatTree):
+    action_list = parse_composition_actions(composition_map, composition_keys)
+    return traverse_objtree(tree, action_list)
 
 def get_composition_map(prefab_data: dict, objtree_root: objtree.Node):
     return get_composition_component(prefab_data, objtree_root)['MonoBehaviour']['compositionMap']
@@ -189,29 +269,357 @@ def get_composition_component(prefab_data: dict, objtree_root: objtree.Node):
         if 'MonoBehaviour' in component and 'compositionMap' in component['MonoBehaviour']:
             return component
 
+# 有libyaml时使用C实现的SafeLoader
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# parse_prefab立即解析的组件类型：GameObject、Transform、SpriteRenderer，
+# 以及携带compositionMap的MonoBehaviour；其余文档保留原文，首次访问时再解析
+_EAGER_CLASS_IDS = {'1', '4', '212'}
+
+class PrefabData(dict):
+    """
+    {fileID: dict}映射，未立即解析的文档在首次通过下标访问时解析；
+    延迟解析的结果另行缓存，不会在遍历items()的过程中改变字典大小
+    """
+    def __init__(self):
+        super().__init__()
+        self._pending = {}
+        self._lazy = {}
+
+    def __missing__(self, key):
+        if key not in self._lazy:
+            self._lazy[key] = yaml.load(self._pending[key], Loader=_YamlLoader)
+        return self._lazy[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._pending
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
 def parse_prefab(prefab_path):
+    result = PrefabData()
+    eager_ids = []
+    eager_documents = []
+
+    def add_document(header: str, body: list[str]):
+        # header形如 "--- !u!1 &1234567" 或 "--- !u!1 &1234567 stripped"
+        class_id = header.split()[1].replace('!u!', '')
+        id = header.split('&')[1].split()[0]
+        text = ''.join(body)
+        if class_id in _EAGER_CLASS_IDS or (class_id == '114' and 'compositionMap:' in text):
+            eager_ids.append(id)
+            eager_documents.append(text)
+        else:
+            result._pending[id] = text
+
+    header = None
+    body = []
     with open(prefab_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-
-    result = {}
-    start_index = None
-    for index, line in enumerate(lines): 
-        if line.startswith('---') or index == len(lines) - 1:
-            if start_index != None:
-                id = lines[start_index].split('&')[1].strip()
-                yaml_str = ''.join(lines[start_index + 1:index])
-                yaml_data = yaml.safe_load(yaml_str)
-                result[id] = yaml_data
-            start_index = index
+        for line in f:
+            if line.startswith('---'):
+                if header is not None:
+                    add_document(header, body)
+                header = line
+                body = []
+            elif header is not None:
+                body.append(line)
+    if header is not None:
+        add_document(header, body)
+
+    # 需要的文档拼成一个多文档流，一次交给解析器
+    stream = ''.join(f'---\n{text}' for text in eager_documents)
+    for id, yaml_data in zip(eager_ids, yaml.load_all(stream, Loader=_YamlLoader)):
+        result[id] = yaml_data
 
     return result
 
+def figure_file_name(prefab_path: str, composition_keys: list[str]) -> str:
+    """以composition_keys下划线连接作为输出文件名"""
+    figure_name = prefab_path.split('/')[-1].split('.')[0]
+    figure_tags = '_'.join(composition_keys).replace('/', '_')
+    return figure_name + '_' + figure_tags + '.png'
+
+DEFAULT_PREFIX_CACHE_MB = 512
+DEFAULT_PLAN_CACHE_SIZE = 256
+
+class IncrementalRenderer:
+    """
+    批量合成差分立绘：按规范化的动作（见CompositionTable.normalized_actions）缓存图层规划，
+    并缓存共同图层前缀（身体、手臂等）的中间画布，只混合不同的尾部图层；
+    画布尺寸与每层位置都计入前缀键，因此结果与逐张完整合成逐像素一致
+    """
+    def __init__(self, character: 'charcache.Character', engine: blend.BlendEngine=blend.BlendEngine.FLOAT32,
+                 cache_bytes: int=DEFAULT_PREFIX_CACHE_MB * 1024 * 1024, image_cropper: breakup.ImageCropper=None,
+                 plan_cache_size: int=DEFAULT_PLAN_CACHE_SIZE):
+        """
+        image_cropper: 该角色的纹理，默认使用模块级的image_cropper与sprite_index
+        plan_cache_size: 最多保留的规划数（prepare登记、尚未合成的不计入，也不会被淘汰）
+        """
+        self.character = character
+        self.image_cropper = image_cropper
+        self.engine = engine
+        self.cache_bytes = cache_bytes
+        self.plan_cache_size = plan_cache_size
+        self._plans = OrderedDict()         # 动作 -> FigurePlan，LRU顺序
+        self._snapshots = OrderedDict()     # 前缀键 -> ImageBlender，LRU顺序
+        self._snapshot_bytes = 0
+        self._prefix_uses = {}              # 前缀键 -> 预计还会用到该前缀的立绘数
+        self._prepared = {}                 # 动作 -> [prepare登记的剩余次数, FigurePlan]
+        self._observed = {}                 # 动作 -> 未登记合成的次数，已计入_prefix_uses，规划被淘汰时扣除
+
+    def _build_plan(self, actions: tuple) -> FigurePlan:
+        character = self.character
+        with ptimer.span('plan'):
+            composition_node_list = traverse_objtree(character.tree, dict(actions)) # 分析目标差分立绘的组件列表
+            composition_node_list.reverse()
+            return plan_layers(composition_node_list, character.tree, character.export_struct)
+
+    def _plan(self, actions: tuple) -> FigurePlan:
+        if actions in self._prepared:
+            return self._prepared[actions][1]
+        plan = self._plans.get(actions)
+        if plan is not None:
+            self._plans.move_to_end(actions)
+            return plan
+        plan = self._build_plan(actions)
+        self._cache_plan(actions, plan)
+        return plan
+
+    def _cache_plan(self, actions: tuple, plan: FigurePlan):
+        self._plans[actions] = plan
+        while len(self._plans) > self.plan_cache_size:
+            evicted_actions, evicted = self._plans.popitem(last=False)
+            observed = self._observed.pop(evicted_actions, 0)
+            if observed:
+                self._release_prefixes(evicted, observed)
+
+    def _release_prefixes(self, plan: FigurePlan, count: int):
+        """扣除plan各前缀的预计使用次数，归零的条目删除，返回这些前缀键"""
+        released = []
+        for prefix_key in self._prefix_keys(plan):
+            uses = self._prefix_uses.get(prefix_key, 0) - count
+            if uses > 0:
+                self._prefix_uses[prefix_key] = uses
+            else:
+                self._prefix_uses.pop(prefix_key, None)
+                released.append(prefix_key)
+        return released
+
+    def plan(self, composition_keys: list[str]) -> FigurePlan:
+        return self._plan(self.character.composition.normalized_actions(composition_keys))
+
+    @staticmethod
+    def _prefix_keys(plan: FigurePlan) -> list:
+        """
+        下标i对应前i+1个图层组成的前缀；每个键为(上一个前缀键, 图层)，与之前的键共享，
+        一个规划的全部前缀键只占O(图层数)的引用
+        """
+        prefix_keys = []
+        prefix_key = (plan.width, plan.height)
+        for layer in plan.layers:
+            prefix_key = (prefix_key, layer)
+            prefix_keys.append(prefix_key)
+        return prefix_keys
+
+    def prepare(self, composition_keys_list: list[list[str]]):
+        """登记即将合成的一批立绘，据此只在确有多张立绘共用的分叉处缓存中间画布"""
+        for composition_keys in composition_keys_list:
+            actions = self.character.composition.normalized_actions(composition_keys)
+            if actions in self._prepared:
+                entry = self._prepared[actions]
+            else:
+                plan = self._plans.pop(actions, None)
+                entry = self._prepared[actions] = [0, plan if plan is not None else self._build_plan(actions)]
+            entry[0] += 1
+            for prefix_key in self._prefix_keys(entry[1]):
+                self._prefix_uses[prefix_key] = self._prefix_uses.get(prefix_key, 0) + 1
+
+    def render_order(self, composition_keys_list: list[list[str]]) -> list[int]:
+        """按图层序列排序，使共用前缀的立绘相邻，提高缓存命中率"""
+        def sort_key(index):
+            plan = self.plan(composition_keys_list[index])
+            return (plan.width, plan.height, tuple(layer.node_id for layer in plan.layers))
+        return sorted(range(len(composition_keys_list)), key=sort_key)
+
+    def _store_snapshot(self, prefix_key, image_blender: blend.ImageBlender):
+        # 放不进缓存的前缀不必复制画布
+        if image_blender.nbytes > self.cache_bytes:
+            return
+        snapshot = image_blender.copy()
+        self._snapshots[prefix_key] = snapshot
+        self._snapshot_bytes += snapshot.nbytes
+        while self._snapshot_bytes > self.cache_bytes:
+            _key, evicted = self._snapshots.popitem(last=False)
+            self._snapshot_bytes -= evicted.nbytes
+
+    def _drop_snapshot(self, prefix_key):
+        snapshot = self._snapshots.pop(prefix_key, None)
+        if snapshot is not None:
+            self._snapshot_bytes -= snapshot.nbytes
+
+    def render(self, composition_keys: list[str]):
+        return self.render_actions(self.character.composition.normalized_actions(composition_keys))
+
+    def render_actions(self, actions: tuple):
+        """actions: CompositionTable.normalized_actions的结果"""
+        plan = self._plan(actions)
+        prefix_keys = self._prefix_keys(plan)
+
+        # 已登记的立绘先扣除自身，剩余次数即其他立绘对该前缀的需求；
+        # 未登记的立绘以此前出现过的次数作为预估
+        prepared = actions in self._prepared
+        if prepared:
+            entry = self._prepared[actions]
+            entry[0] -= 1
+            if entry[0] == 0:
+                del self._prepared[actions]
+                self._cache_plan(actions, plan)
+            released = self._release_prefixes(plan, 1)
+
+        # 从最长的已缓存前缀继续
+        start = 0
+        image_blender = None
+        for i in range(len(prefix_keys) - 1, -1, -1):
+            snapshot = self._snapshots.get(prefix_keys[i])
+            if snapshot is not None:
+                self._snapshots.move_to_end(prefix_keys[i])
+                image_blender = snapshot.copy()
+                start = i + 1
+                break
+        if image_blender is None:
+            image_blender = blend.ImageBlender(plan.width, plan.height, engine=self.engine)
+
+        # 混合剩余图层，在其他立绘也会用到、且之后发生分叉的位置保存中间画布
+        for i in range(start, len(plan.layers)):
+            if self.image_cropper is not None:
+                blend_layers(image_blender, plan.layers[i:i + 1], self.image_cropper, self.character.sprite_index)
+            else:
+                blend_layers(image_blender, plan.layers[i:i + 1])
+            uses = self._prefix_uses.get(prefix_keys[i], 0)
+            next_uses = self._prefix_uses.get(prefix_keys[i + 1], 0) if i + 1 < len(prefix_keys) else 0
+            if self.cache_bytes > 0 and uses > next_uses and prefix_keys[i] not in self._snapshots:
+                self._store_snapshot(prefix_keys[i], image_blender)
+
+        if prepared:
+            # 不会再被用到的前缀立即释放
+            for prefix_key in released:
+                self._drop_snapshot(prefix_key)
+        elif actions in self._plans:
+            # 只统计仍在缓存中的规划，规划被淘汰时才能扣除
+            self._observed[actions] = self._observed.get(actions, 0) + 1
+            for prefix_key in prefix_keys:
+                self._prefix_uses[prefix_key] = self._prefix_uses.get(prefix_key, 0) + 1
+
+        return image_blender.image()
+
+def render_figure(composition_keys: list[str], renderer: IncrementalRenderer, output_dir: str, writer: imgwriter.ImageWriter) -> dict:
+    """合成一张差分立绘并交给writer保存，返回各阶段耗时（Image saving为提交等待的时间）"""
+    timer = ptimer.Timer()
+    timings = {}
+    renderer.plan(composition_keys)
+
+    timings["Composition calculating"] = timer.checkpoint("Composition calculating")
+
+    result = renderer.render(composition_keys)  # 重组立绘
+
+    timings["Sprites compositing"] = timer.checkpoint("Sprites compositing")
+
+    export_struct = renderer.character.export_struct
+    output_path = os.path.join(output_dir, figure_file_name(export_struct.prefab_path, composition_keys))
+    os.makedirs(output_dir, exist_ok=True)  # 创建目录
+
+    # result.show()
+
+    output_path = writer.submit(result, output_path)
+    if ptimer.verbosity >= 1:
+        print(f"\033[34mComposited figure queued for {output_path}\033[0m")
+    timings["Image saving"] = timer.checkpoint("Image saving")
+    return timings
+
+def render_figures(composition_keys_list: list[list[str]], renderer: IncrementalRenderer, output_dir: str,
+                   writer_options: imgwriter.WriterOptions=imgwriter.WriterOptions()) -> tuple[list[dict], float]:
+    """返回 (各立绘的阶段耗时, 后台编码写入的累计耗时)"""
+    renderer.prepare(composition_keys_list)
+    with imgwriter.ImageWriter(writer_options) as writer:
+        timings_list = [render_figure(composition_keys, renderer, output_dir, writer) for composition_keys in composition_keys_list]
+    return timings_list, writer.encode_seconds
+
+MANIFEST_FILE_NAME = 'manifest.json'
+
+def write_figure_manifest(manifest: list[dict], prefab_path: str, output_dir: str, image_format: str='png') -> str:
+    """
+    manifest: config.py枚举得到的 [{'keys': 组合, 'figure': 实际合成的组合}]，
+    写入output_dir/manifest.json，记录每个组合对应的立绘文件（图层相同的组合共用一个文件）
+    """
+    extension = imgwriter.FORMAT_EXTENSIONS[image_format]
+    entries = [{'keys': entry['keys'], 'file': os.path.splitext(figure_file_name(prefab_path, entry['figure']))[0] + extension}
+               for entry in manifest]
+    output_path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump({'figures': len({entry['file'] for entry in entries}), 'combinations': entries}, f, indent=4, ensure_ascii=False)
+    return output_path
+
+# 并行模式下每个子进程持有的合成器与共享纹理
+_worker_renderer = None
+_worker_texture_shm = None
+
+def _init_render_worker(character: 'charcache.Character', texture_descriptor, engine: blend.BlendEngine, cache_bytes: int, ptimer_state: tuple):
+    global image_cropper, sprite_index, _worker_renderer, _worker_texture_shm
+    ptimer.restore(ptimer_state)
+    _worker_texture_shm, texture_array = breakup.attach_texture_array(texture_descriptor)
+    image_cropper = breakup.ImageCropper.from_array(texture_array)
+    sprite_index = character.sprite_index
+    _worker_renderer = IncrementalRenderer(character, engine, cache_bytes)
+
+def _render_figures_task(composition_keys_list: list[list[str]], output_dir: str, writer_options: imgwriter.WriterOptions) -> tuple[list[dict], float, tuple]:
+    """返回值另附本块的采样结果（见ptimer.Profiler.collect），由主进程合并"""
+    timings_list, encode_seconds = render_figures(composition_keys_list, _worker_renderer, output_dir, writer_options)
+    profiler = ptimer.profiler()
+    return timings_list, encode_seconds, profiler.collect() if profiler is not None else None
+
+def render_figures_parallel(composition_keys_list: list[list[str]], character: 'charcache.Character', output_dir: str,
+                            engine: blend.BlendEngine, jobs: int, cache_bytes: int, raw_cache_dir: str=None,
+                            writer_options: imgwriter.WriterOptions=imgwriter.WriterOptions()) -> tuple[list[dict], float]:
+    """
+    多进程合成：纹理只解码一次并放入共享内存，子进程直接映射使用；
+    按图层序列排序后切成连续的块分给子进程，使共用前缀的立绘落在同一进程；
+    输出文件名只由composition_keys决定，与串行模式一致，每个进程各自拥有cache_bytes的前缀缓存
+    """
+    planner = IncrementalRenderer(character, engine, 0)
+    ordered = [composition_keys_list[i] for i in planner.render_order(composition_keys_list)]
+    chunk_count = min(len(ordered), jobs * 2)
+    chunks = [ordered[len(ordered) * i // chunk_count : len(ordered) * (i + 1) // chunk_count] for i in range(chunk_count)]
+
+    texture_array = breakup.ImageCropper(character.export_struct.texture_path, raw_cache_dir).image_array
+    texture_shm, texture_descriptor = breakup.share_texture_array(texture_array)
+    del texture_array
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_render_worker,
+                                 initargs=(character, texture_descriptor, engine, cache_bytes, ptimer.state())) as executor:
+            results = list(executor.map(_render_figures_task, chunks, repeat(output_dir), repeat(writer_options)))
+        profiler = ptimer.profiler()
+        for _, _, collected in results:
+            if profiler is not None and collected is not None:
+                profiler.merge(*collected)
+        return [timings for chunk_timings, _, _ in results for timings in chunk_timings], sum(seconds for _, seconds, _ in results)
+    finally:
+        texture_shm.close()
+        texture_shm.unlink()
+
 def main(config=None):
     parser = argparse.ArgumentParser(description="根据拆分的立绘组件和Prefab文件重组角色立绘")
 
     parser.add_argument('-d', '--dir', type=str, help='解包文件路径，应为ExportedProject的上级目录')
     parser.add_argument('-o', '--output', type=str, default='output', help='输出文件夹路径')
     parser.add_argument('-k', '--compositionKeys', type=str, nargs='*', help='需要重组的Composition键名列表')
+    parser.add_argument('-e', '--engine', type=str, choices=['float32', 'uint8'], default='float32', help='图层混合引擎，uint8为逐层取整的参考实现')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='并行合成的进程数')
+    parser.add_argument('--cache-mb', type=int, default=DEFAULT_PREFIX_CACHE_MB, help='共同图层前缀缓存的内存上限（MB），0为不缓存')
+    parser.add_argument('--no-raw-cache', help='不使用（也不写入）纹理原始像素缓存', action='store_true')
+    imgwriter.add_arguments(parser)
+    ptimer.add_arguments(parser)
 
     timer = ptimer.Timer()
     global_timer = ptimer.Timer()
@@ -221,52 +629,43 @@ def main(config=None):
     else:
         args = parser.parse_args()  # 解析命令行参数
         args.compositionKeys = [args.compositionKeys]
+    ptimer.configure_from_args(args)
 
-    export_struct = expstruct.analyse_export_structure(args.dir)
-
-    prefab_data = parse_prefab(export_struct.prefab_path) # 结构化原始Unity Prefab文件
-
-    objtree_root, node_map = objtree.build_tree(prefab_data)
+    engine = blend.BlendEngine[getattr(args, 'engine', 'float32').upper()]
+    jobs = getattr(args, 'jobs', 1) or 1
+    cache_bytes = getattr(args, 'cache_mb', DEFAULT_PREFIX_CACHE_MB) * 1024 * 1024
+    writer_options = imgwriter.options_from_args(args)
 
-    # objtree.print_tree(objtree_root, node_map)
+    character = charcache.load_character(args.dir) # 编译（或从缓存读取）Prefab、材质与Sprite索引
 
-    composition_map = get_composition_map(prefab_data, objtree_root)
+    timer.checkpoint("Character loading")
+    raw_cache_dir = None if getattr(args, 'no_raw_cache', False) else character.export_struct.cache_dir
 
-    timer.checkpoint("Prefab parsing")
-
-    global image_cropper
-    image_cropper = breakup.ImageCropper(export_struct.texture_path)
-
-    for composition_keys in args.compositionKeys:
-        timer = ptimer.Timer()
-        composition_node_list = parse_composition(composition_map, composition_keys, objtree_root, node_map) # 分析目标差分立绘的组件列表
-        # for node_id in composition_node_list:
-        #     node = node_map[node_id]
-        #     print(f"- {node.name} (id: {node.id})")
-
-        # return 
-
-        timer.checkpoint("Composition calculating")
-
-        composition_node_list.reverse()
-
-        result = composite_sprites(composition_node_list, node_map, export_struct)  # 重组立绘
-
-        timer.checkpoint("Sprites compositing")
-
-        # 将composition_keys以下划线连接
-        figure_name = export_struct.prefab_path.split('/')[-1].split('.')[0]
-        figure_tags = '_'.join(composition_keys).replace('/', '_')
-        output_file = figure_name + '_' + figure_tags + '.png'
-        output_path = os.path.join(args.output, output_file)
-        os.makedirs(args.output, exist_ok=True)  # 创建目录
-
-        # result.show()
-
-        result.save(output_path)
-        print(f"\033[34mComposited figure saved at {output_path}\033[0m")
-        timer.checkpoint("Image saving")
+    if jobs > 1 and len(args.compositionKeys) > 1:
+        timings_list, encode_seconds = render_figures_parallel(args.compositionKeys, character, args.output, engine,
+                                                               min(jobs, len(args.compositionKeys)), cache_bytes, raw_cache_dir,
+                                                               writer_options)
+    else:
+        global image_cropper, sprite_index
+        image_cropper = breakup.ImageCropper(character.export_struct.texture_path, raw_cache_dir)
+        sprite_index = character.sprite_index
+        renderer = IncrementalRenderer(character, engine, cache_bytes)
+        ordered = [args.compositionKeys[i] for i in renderer.render_order(args.compositionKeys)]
+        timings_list, encode_seconds = render_figures(ordered, renderer, args.output, writer_options)
+
+    manifest = getattr(args, 'compositionManifest', None)
+    if manifest:
+        manifest_path = write_figure_manifest(manifest, character.export_struct.prefab_path, args.output, writer_options.image_format)
+        print(f"\033[34mFigure manifest saved to {manifest_path}\033[0m")
+
+    # 汇总各阶段耗时（并行模式下为所有进程的累计值）
+    if ptimer.verbosity >= 1:
+        for stage in ["Composition calculating", "Sprites compositing", "Image saving"]:
+            total = sum(timings[stage] for timings in timings_list)
+            print(f"\033[32m{stage} took {total:.2f} seconds in total over {len(timings_list)} figures.\033[0m")
+        print(f"\033[32mImage encoding took {encode_seconds:.2f} seconds in total.\033[0m")
     global_timer.checkpoint("Total time")
+    ptimer.finish_from_args(args)
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,49 +2,107 @@ from PIL import Image
 import numpy as np
 from enum import Enum
 
-def _soft_light(bg, fg):
-    bg = bg / 255.0
-    fg = fg / 255.0
-    return 255.0 * ((1 - 2 * fg) * bg ** 2 + 2 * fg * bg)
+try:
+    import numexpr as _numexpr     # 可选加速后端
+except ImportError:
+    _numexpr = None
 
-def _overlay(bg, fg):
-    return np.where(bg < 128,
-                    2 * bg * fg / 255.0,
-                    255 - 2 * (255 - bg) * (255 - fg) / 255.0)
+class _ScratchBuffers:
+    """按需增长的float32暂存区，混合核在其中写入中间结果，避免逐层重新分配"""
+    def __init__(self):
+        self._buffers = []
 
-def _multiply(bg, fg):
-    return bg * fg / 255.0
+    def get(self, index: int, shape: tuple):
+        size = int(np.prod(shape))
+        while len(self._buffers) <= index:
+            self._buffers.append(np.empty(0, dtype=np.float32))
+        if self._buffers[index].size < size:
+            self._buffers[index] = np.empty(size, dtype=np.float32)
+        return self._buffers[index][:size].reshape(shape)
 
-def _alpha(_bg, fg):
+# 混合核：一次处理整块连续的RGB数据（(H, W, 3)或(3, H, W)），结果写入out（或直接返回fg），
+# scale为通道满值：uint8参考引擎为255，float32引擎为1
+# 暂存区中0号由调用方用作out，1~3号供混合核内部使用
+def _soft_light(bg, fg, out, scale, scratch):
+    if scale != 1:
+        bg = np.divide(bg, scale, out=scratch.get(1, bg.shape))
+        fg = np.divide(fg, scale, out=scratch.get(2, fg.shape))
+    tmp = scratch.get(3, bg.shape)
+    # (1 - 2 * fg) * bg ** 2 + 2 * fg * bg
+    np.multiply(fg, 2, out=out)
+    np.subtract(1, out, out=out)
+    np.square(bg, out=tmp)
+    out *= tmp
+    np.multiply(fg, 2, out=tmp)
+    tmp *= bg
+    out += tmp
+    if scale != 1:
+        out *= scale
+    return out
+
+def _overlay(bg, fg, out, scale, scratch):
+    # 两个分支都原地写入暂存区再按掩码合并，不产生临时数组
+    # （按掩码只重算亮部需要gather/scatter，实测在连续内存上反而更慢）
+    np.multiply(bg, 2, out=out)
+    out *= fg
+    if scale != 1:
+        out /= scale
+    high = scratch.get(1, bg.shape)
+    np.subtract(scale, bg, out=high)
+    high *= 2
+    high *= np.subtract(scale, fg, out=scratch.get(2, fg.shape))
+    if scale != 1:
+        high /= scale
+    np.subtract(scale, high, out=high)
+    np.copyto(out, high, where=bg >= 128 * scale / 255)
+    return out
+
+def _multiply(bg, fg, out, scale, scratch):
+    np.multiply(bg, fg, out=out)
+    if scale != 1:
+        out /= scale
+    return out
+
+def _alpha(_bg, fg, _out, _scale, _scratch):
     return fg
 
-def _general_blend_array(background_array, foreground_array, blend_function):
-    arr1 = background_array.astype(np.float32)
-    arr2 = foreground_array.astype(np.float32)
+def _soft_light_numexpr(bg, fg, out, scale, scratch):
+    return _numexpr.evaluate('s * ((1 - 2 * (fg / s)) * (bg / s) ** 2 + 2 * (fg / s) * (bg / s))',
+                             local_dict={'bg': bg, 'fg': fg, 's': np.float32(scale)}, out=out, casting='unsafe')
+
+def _overlay_numexpr(bg, fg, out, scale, scratch):
+    return _numexpr.evaluate('where(bg < t, 2 * bg * fg / s, s - 2 * (s - bg) * (s - fg) / s)',
+                             local_dict={'bg': bg, 'fg': fg, 's': np.float32(scale), 't': np.float32(128 * scale / 255)},
+                             out=out, casting='unsafe')
+
+def _multiply_numexpr(bg, fg, out, scale, scratch):
+    return _numexpr.evaluate('bg * fg / s', local_dict={'bg': bg, 'fg': fg, 's': np.float32(scale)}, out=out, casting='unsafe')
+
+def _general_blend_array(background_array, foreground_array, blend_kernel, scratch: _ScratchBuffers=None):
+    if scratch is None:
+        scratch = _ScratchBuffers()
+    # RGB单独转换为连续数组，混合核才能按一维连续内存遍历
+    bg_rgb = background_array[:, :, 0:3].astype(np.float32)
+    fg_rgb = foreground_array[:, :, 0:3].astype(np.float32)
 
     # 提取 alpha 通道
-    a1 = arr1[:, :, 3] / 255.0
-    a2 = arr2[:, :, 3] / 255.0
+    a1 = background_array[:, :, 3].astype(np.float32) / 255.0
+    a2 = foreground_array[:, :, 3].astype(np.float32) / 255.0
 
     # 计算混合后的 alpha 通道
     a = a1 + a2 - a1 * a2
 
-    r_blend = blend_function(arr1[:, :, 0], arr2[:, :, 0])
-    g_blend = blend_function(arr1[:, :, 1], arr2[:, :, 1])
-    b_blend = blend_function(arr1[:, :, 2], arr2[:, :, 2])
-
-    r = r_blend * a2 + arr1[:, :, 0] * (1 - a2)
-    g = g_blend * a2 + arr1[:, :, 1] * (1 - a2)
-    b = b_blend * a2 + arr1[:, :, 2] * (1 - a2)
+    rgb_shape = bg_rgb.shape
+    rgb_blend = blend_kernel(bg_rgb, fg_rgb, scratch.get(0, rgb_shape), 255.0, scratch)
 
-    # 将结果转换回整数
-    r = np.clip(r, 0, 255).astype(np.uint8)
-    g = np.clip(g, 0, 255).astype(np.uint8)
-    b = np.clip(b, 0, 255).astype(np.uint8)
-    a = np.clip(a * 255, 0, 255).astype(np.uint8)
+    # rgb = rgb_blend * a2 + arr1 * (1 - a2)
+    rgb = np.multiply(rgb_blend, a2[:, :, np.newaxis], out=scratch.get(1, rgb_shape))
+    rgb += np.multiply(bg_rgb, (1 - a2)[:, :, np.newaxis], out=scratch.get(2, rgb_shape))
 
-    # 合并通道
-    result = np.stack([r, g, b, a], axis=2)
+    # 将结果转换回整数并合并通道
+    result = np.empty(background_array.shape, dtype=np.uint8)
+    result[:, :, 0:3] = np.clip(rgb, 0, 255, out=rgb)
+    result[:, :, 3] = np.clip(a * 255, 0, 255)
     return result
 
 def _transparent_expand_array(image_array, width, height, position: tuple):
@@ -78,15 +136,171 @@ class BlendMode(Enum):
     OVERLAY = 2
     SOFTLIGHT = 3
 
+class BlendEngine(Enum):
+    UINT8 = 0       # 参考实现：每一层混合后都量化回uint8画布
+    FLOAT32 = 1     # 常驻float32工作画布，只在image()时量化一次
+
+# UINT8参考引擎固定使用NumPy混合核，保证结果可复现
+_BLEND_FUNCTIONS = {
+    BlendMode.ALPHA: _alpha,
+    BlendMode.MULTIPLY: _multiply,
+    BlendMode.OVERLAY: _overlay,
+    BlendMode.SOFTLIGHT: _soft_light,
+}
+
+# FLOAT32引擎在导入时选择后端：安装了numexpr时使用其融合表达式，否则回退到NumPy
+KERNEL_BACKEND = 'numexpr' if _numexpr is not None else 'numpy'
+if _numexpr is not None:
+    _FLOAT_BLEND_FUNCTIONS = {
+        BlendMode.ALPHA: _alpha,
+        BlendMode.MULTIPLY: _multiply_numexpr,
+        BlendMode.OVERLAY: _overlay_numexpr,
+        BlendMode.SOFTLIGHT: _soft_light_numexpr,
+    }
+else:
+    _FLOAT_BLEND_FUNCTIONS = _BLEND_FUNCTIONS
+
 class ImageBlender:
-    def __init__(self, width, height):
-        self.canvas_array = np.zeros((height, width, 4), dtype=np.uint8)
+    def __init__(self, width, height, local: bool=True, engine: BlendEngine=BlendEngine.FLOAT32):
+        """
+        local: 只在组件包围盒内混合（与全画布展开的结果逐像素一致）；
+        False 时使用原始的全画布展开路径，作为对照，只支持UINT8引擎
+        engine: UINT8 为逐层取整的参考实现；FLOAT32（默认）在整个合成过程中保留归一化的float32画布与遮罩，
+        颜色通道按与UINT8相同的递推累积（即预乘alpha后的值），不再逐层取整；
+        其画布按通道平面存储，形状为(4, height, width)
+        """
+        if engine == BlendEngine.FLOAT32:
+            if not local:
+                raise ValueError("FLOAT32 engine only supports local blending")
+            self.canvas_array = np.zeros((4, height, width), dtype=np.float32)
+        else:
+            self.canvas_array = np.zeros((height, width, 4), dtype=np.uint8)
         self.width = width
         self.height = height
+        self.local = local
+        self.engine = engine
         self.mask_map = {}
+        self._scratch = _ScratchBuffers()
+
+    def copy(self) -> 'ImageBlender':
+        """复制画布与遮罩（不共享内存），用于缓存与恢复中间合成结果"""
+        result = ImageBlender.__new__(ImageBlender)
+        result.canvas_array = self.canvas_array.copy()
+        result.width = self.width
+        result.height = self.height
+        result.local = self.local
+        result.engine = self.engine
+        result.mask_map = {key: mask.copy() for key, mask in self.mask_map.items()}
+        result._scratch = _ScratchBuffers()
+        return result
+
+    @property
+    def nbytes(self) -> int:
+        return self.canvas_array.nbytes + sum(mask.nbytes for mask in self.mask_map.values())
+
+    def _clip_region(self, position: tuple, shape: tuple, clip_rect: tuple=None):
+        """
+        返回组件在画布上(canvas)与组件自身(sprite)的切片，完全落在画布外时返回None；
+        clip_rect为(left, top, right, bottom)时，只返回与该矩形相交的部分
+        """
+        x, y = position
+        sprite_height, sprite_width = shape[0:2]
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + sprite_width, self.width), min(y + sprite_height, self.height)
+        if clip_rect is not None:
+            left, top = max(left, clip_rect[0]), max(top, clip_rect[1])
+            right, bottom = min(right, clip_rect[2]), min(bottom, clip_rect[3])
+        if left >= right or top >= bottom:
+            return None
+        canvas_slice = (slice(top, bottom), slice(left, right))
+        sprite_slice = (slice(top - y, bottom - y), slice(left - x, right - x))
+        return canvas_slice, sprite_slice
+
+    def copy_region_from(self, source: 'ImageBlender', rect: tuple):
+        """
+        用source在rect=(left, top, right, bottom)内的画布与遮罩覆盖本画布的对应区域，
+        source中不存在的遮罩在该区域清零；两者尺寸与engine须一致
+        """
+        assert (source.width, source.height, source.engine) == (self.width, self.height, self.engine), "Mismatched blender"
+        left, top, right, bottom = rect
+        region = (slice(top, bottom), slice(left, right))
+        if self.engine == BlendEngine.FLOAT32:
+            self.canvas_array[(slice(None),) + region] = source.canvas_array[(slice(None),) + region]
+        else:
+            self.canvas_array[region] = source.canvas_array[region]
+        for key in set(self.mask_map) | set(source.mask_map):
+            if key not in self.mask_map:
+                self.mask_map[key] = np.zeros_like(source.mask_map[key])
+            if key in source.mask_map:
+                self.mask_map[key][region] = source.mask_map[key][region]
+            else:
+                self.mask_map[key][region] = 0
+
+    def blend(self, image, position: tuple, mode: BlendMode=BlendMode.ALPHA, set_mask_key: str=None, apply_mask_key: str=None,
+              clip_rect: tuple=None):
+        """clip_rect: 只更新画布与遮罩在(left, top, right, bottom)内的部分，用于局部重绘"""
+        if mode not in _BLEND_FUNCTIONS:
+            raise ValueError(f"Unsupported blend mode: {mode}")
+        if apply_mask_key is not None:
+            assert apply_mask_key in self.mask_map, f"Mask with key '{apply_mask_key}' not found."
+
+        if self.local and set_mask_key is not None and set_mask_key not in self.mask_map:
+            # 组件落在画布（或clip_rect）外时遮罩也须存在，供之后的Masked图层使用
+            mask_dtype = np.float32 if self.engine == BlendEngine.FLOAT32 else np.uint8
+            self.mask_map[set_mask_key] = np.zeros((self.height, self.width), dtype=mask_dtype)
+
+        if self.engine == BlendEngine.FLOAT32:
+            self._blend_float(np.asarray(image), position, mode, set_mask_key, apply_mask_key, clip_rect)
+        elif self.local:
+            self._blend_local(np.array(image), position, mode, set_mask_key, apply_mask_key, clip_rect)
+        else:
+            if clip_rect is not None:
+                raise ValueError("clip_rect requires local blending")
+            self._blend_expanded(np.array(image), position, mode, set_mask_key, apply_mask_key)
+
+    def _blend_local(self, image_array, position: tuple, mode: BlendMode, set_mask_key: str, apply_mask_key: str, clip_rect: tuple=None):
+        region = self._clip_region(position, image_array.shape, clip_rect)
+        if region is None:
+            return
+        canvas_slice, sprite_slice = region
+        sprite_array = image_array[sprite_slice]
+
+        if set_mask_key is not None:
+            mask_region = self.mask_map[set_mask_key][canvas_slice]
+            np.maximum(mask_region, sprite_array[:, :, 3], out=mask_region)  # 只保留alpha通道
+
+        if apply_mask_key is not None:
+            sprite_array = _clipping_mask_array(sprite_array, self.mask_map[apply_mask_key][canvas_slice])
 
-    def blend(self, image, position: tuple, mode: BlendMode=BlendMode.ALPHA, set_mask_key: str=None, apply_mask_key: str=None):
-        image_array = np.array(image)
+        # 包围盒外 fg 的 alpha 为0，混合结果恒等于原画布，因此只需写回包围盒
+        self.canvas_array[canvas_slice] = _general_blend_array(self.canvas_array[canvas_slice], sprite_array, _BLEND_FUNCTIONS[mode], self._scratch)
+
+    def _blend_float(self, image_array, position: tuple, mode: BlendMode, set_mask_key: str, apply_mask_key: str, clip_rect: tuple=None):
+        region = self._clip_region(position, image_array.shape, clip_rect)
+        if region is None:
+            return
+        canvas_slice, sprite_slice = region
+        fg = image_array[sprite_slice].transpose(2, 0, 1).astype(np.float32, order='C')
+        fg *= np.float32(1 / 255)
+        fg_alpha = fg[3]
+
+        if set_mask_key is not None:
+            mask_region = self.mask_map[set_mask_key][canvas_slice]
+            np.maximum(mask_region, fg_alpha, out=mask_region)
+
+        if apply_mask_key is not None:
+            fg_alpha *= self.mask_map[apply_mask_key][canvas_slice]
+
+        bg = self.canvas_array[(slice(None),) + canvas_slice]
+        bg_rgb = bg[0:3]
+        rgb_shape = bg_rgb.shape
+        blended = _FLOAT_BLEND_FUNCTIONS[mode](bg_rgb, fg[0:3], self._scratch.get(0, rgb_shape), 1.0, self._scratch)
+        delta = np.subtract(blended, bg_rgb, out=self._scratch.get(1, rgb_shape))
+        delta *= fg_alpha
+        bg_rgb += delta
+        bg[3] += fg_alpha * (1 - bg[3])
+
+    def _blend_expanded(self, image_array, position: tuple, mode: BlendMode, set_mask_key: str, apply_mask_key: str):
         expanded_array = _transparent_expand_array(image_array, self.width, self.height, position)
 
         if set_mask_key is not None:
@@ -97,19 +311,12 @@ class ImageBlender:
                 self.mask_map[set_mask_key] = mask_array
         
         if apply_mask_key is not None:
-            assert apply_mask_key in self.mask_map, f"Mask with key '{apply_mask_key}' not found."
             expanded_array = _clipping_mask_array(expanded_array, self.mask_map[apply_mask_key])
 
-        if mode == BlendMode.ALPHA:
-            self.canvas_array = _general_blend_array(self.canvas_array, expanded_array, _alpha)
-        elif mode == BlendMode.MULTIPLY:
-            self.canvas_array = _general_blend_array(self.canvas_array, expanded_array, _multiply)
-        elif mode == BlendMode.OVERLAY:
-            self.canvas_array = _general_blend_array(self.canvas_array, expanded_array, _overlay)
-        elif mode == BlendMode.SOFTLIGHT:
-            self.canvas_array = _general_blend_array(self.canvas_array, expanded_array, _soft_light)
-        else:
-            raise ValueError(f"Unsupported blend mode: {mode}")
+        self.canvas_array = _general_blend_array(self.canvas_array, expanded_array, _BLEND_FUNCTIONS[mode], self._scratch)
         
     def image(self):
+        if self.engine == BlendEngine.FLOAT32:
+            quantized = np.rint(np.clip(self.canvas_array.transpose(1, 2, 0) * 255, 0, 255)).astype(np.uint8)
+            return Image.fromarray(quantized)
         return Image.fromarray(self.canvas_array)
\ No newline at end of file
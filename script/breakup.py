@@ -1,11 +1,14 @@
 # import sys
 import os
 import argparse
-import yaml
+from multiprocessing import shared_memory, resource_tracker
 from PIL import Image
 import numpy as np
 
 import expstruct
+import imgwriter
+import spriteidx
+import spritepack
 
 def preprocess_yaml(yaml_path):
     with open(yaml_path, 'r', encoding='utf-8') as f:
@@ -15,12 +18,8 @@ def preprocess_yaml(yaml_path):
     return content
 
 def get_rect(sprite_path):
-    data = yaml.safe_load(preprocess_yaml(sprite_path))
-
-    sprite = data.get('Sprite', {})
-    m_rect = sprite.get('m_Rect', {})
-    # print("m_Rect:", m_rect)
-    return m_rect
+    """单个Sprite的m_Rect；批量读取请使用spriteidx.load_sprite_index"""
+    return spriteidx.read_sprite_entry(sprite_path)['rect']
 
 def crop_texture(texture_path, m_rect):
     image = Image.open(texture_path)
@@ -45,11 +44,86 @@ def _crop_texture_array(texture_array, m_rect):
     
     return cropped_image_array
 
+RAW_CACHE_SUFFIX = '.rgba.npy'
+
+def _raw_cache_path(texture_path, cache_dir) -> str:
+    """缓存文件名包含纹理的大小与mtime，纹理更新后自动失效"""
+    stat = os.stat(texture_path)
+    return os.path.join(cache_dir, f"{os.path.basename(texture_path)}.{stat.st_size}-{stat.st_mtime_ns}{RAW_CACHE_SUFFIX}")
+
+def load_texture_array(texture_path, cache_dir=None) -> np.ndarray:
+    """
+    解码纹理为NumPy数组；指定cache_dir时，首次解码后把原始像素写入.npy，
+    之后以只读内存映射打开，裁剪结果为零拷贝视图，只有访问到的页面才会读入
+    """
+    if cache_dir is None:
+        return np.array(Image.open(texture_path))
+
+    cache_path = _raw_cache_path(texture_path, cache_dir)
+    if os.path.exists(cache_path):
+        try:
+            return np.load(cache_path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            print(f"\033[33mWarning: Ignoring unreadable texture cache {cache_path}: {e}\033[0m")
+
+    image_array = np.array(Image.open(texture_path))
+    os.makedirs(cache_dir, exist_ok=True)
+    # 清理同一纹理的过期缓存
+    stale_prefix = os.path.basename(texture_path) + '.'
+    for entry in os.scandir(cache_dir):
+        if entry.name.startswith(stale_prefix) and entry.name.endswith(RAW_CACHE_SUFFIX) and entry.path != cache_path:
+            os.remove(entry.path)
+    # 先写临时文件再替换，避免并行运行时读到写了一半的缓存
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        np.save(f, image_array)
+    os.replace(temp_path, cache_path)
+    return image_array
+
+def share_texture_array(image_array: np.ndarray):
+    """
+    将解码后的纹理复制到共享内存，返回(SharedMemory, descriptor)；
+    descriptor可传给子进程，由attach_texture_array打开，调用方负责close/unlink
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(image_array.nbytes, 1))
+    shared_array = np.ndarray(image_array.shape, dtype=image_array.dtype, buffer=shm.buf)
+    shared_array[...] = image_array
+    del shared_array    # 释放对shm.buf的引用，否则无法close
+    return shm, (shm.name, image_array.shape, image_array.dtype.str)
+
+def attach_texture_array(descriptor):
+    """在子进程中打开共享纹理，返回(SharedMemory, 只读数组)，需保持SharedMemory存活"""
+    name, shape, dtype = descriptor
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python 3.13之前没有track参数：打开时跳过resource_tracker登记，
+        # 共享内存的生命周期只由创建它的父进程管理
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+    image_array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    image_array.flags.writeable = False
+    return shm, image_array
+
 class ImageCropper:
-    def __init__(self, texture_path):
-        self.image = Image.open(texture_path)
-        self.width, self.height = self.image.size
-        self.image_array = np.array(self.image)
+    def __init__(self, texture_path, cache_dir=None):
+        """cache_dir: 原始像素缓存目录（见load_texture_array），None为每次重新解码"""
+        self.image = None
+        self.image_array = load_texture_array(texture_path, cache_dir)
+        self.height, self.width = self.image_array.shape[0:2]
+
+    @classmethod
+    def from_array(cls, image_array: np.ndarray):
+        """基于已解码的纹理数组（如共享内存）构建，不再读取文件"""
+        cropper = cls.__new__(cls)
+        cropper.image = None
+        cropper.height, cropper.width = image_array.shape[0:2]
+        cropper.image_array = image_array
+        return cropper
 
     def crop(self, m_rect):
         cropped_image_array = _crop_texture_array(self.image_array, m_rect)        
@@ -70,6 +144,11 @@ def main(config=None):
     # parser.add_argument('-t', '--texture', type=str, help='Texture文件路径')
     parser.add_argument('-o', '--output', type=str, default='output', help='输出文件夹路径')
     parser.add_argument('-d', '--dir', type=str, help='解包文件路径，应为ExportedProject的上级目录')
+    parser.add_argument('--no-raw-cache', help='不使用（也不写入）纹理原始像素缓存', action='store_true')
+    parser.add_argument('--pack', help='裁掉透明边缘并打包为精灵图集（PixiJS可加载的JSON + 图集页），代替逐个输出组件', action='store_true')
+    parser.add_argument('--page-size', type=int, default=spritepack.DEFAULT_PAGE_SIZE, help='图集页面的最大边长')
+    parser.add_argument('--padding', type=int, default=spritepack.DEFAULT_PADDING, help='图集中组件之间的间距（像素）')
+    imgwriter.add_arguments(parser)
 
     if config is not None:
         args = config
@@ -81,22 +160,35 @@ def main(config=None):
     # print(f"Output directory: {args.output}")
     os.makedirs(args.output, exist_ok=True)  # 创建目录
 
-    image_cropper = ImageCropper(export_struct.texture_path)
+    raw_cache_dir = None if getattr(args, 'no_raw_cache', False) else export_struct.cache_dir
+    image_cropper = ImageCropper(export_struct.texture_path, raw_cache_dir)
+    sprite_index = spriteidx.load_sprite_index(export_struct)
     # 遍历Sprite目录
     # entries = os.listdir(args.sprite)
     entries = export_struct.sprite_path
-    for name, path in entries.items():
-        if path.endswith('.asset'):
-            # sprite_path = os.path.join(args.sprite, entry)
-            output_path = os.path.join(args.output, f"{name}.png")
-
-            m_rect = get_rect(path)
-            if m_rect['width'] == 0 or m_rect['height'] == 0:
-                print(f"\033[33mWarning: Skipping empty sprite {path}\033[0m")
-                continue
-            # print(f"m_Rect for {entry}: {m_rect}")
-            image_cropper.crop(m_rect).save(output_path)
-            print(f"\033[34mCropped image saved to {output_path}\033[0m")
+    pack = getattr(args, 'pack', False)
+    packed_images = {}
+    with imgwriter.ImageWriter(imgwriter.options_from_args(args)) as writer:
+        for name, path in entries.items():
+            if path.endswith('.asset'):
+                # sprite_path = os.path.join(args.sprite, entry)
+                output_path = os.path.join(args.output, f"{name}.png")
+
+                m_rect = sprite_index.get_rect(name)
+                if m_rect['width'] == 0 or m_rect['height'] == 0:
+                    print(f"\033[33mWarning: Skipping empty sprite {path}\033[0m")
+                    continue
+                # print(f"m_Rect for {entry}: {m_rect}")
+                if pack:
+                    packed_images[name] = image_cropper.crop_array(m_rect)
+                    continue
+                output_path = writer.submit(image_cropper.crop(m_rect), output_path)
+                print(f"\033[34mCropped image queued for {output_path}\033[0m")
+
+        if pack:
+            sheet_name = os.path.basename(export_struct.prefab_path).split('.')[0]
+            spritepack.write_sheets(packed_images, args.output, sheet_name, writer,
+                                    getattr(args, 'page_size', spritepack.DEFAULT_PAGE_SIZE), getattr(args, 'padding', spritepack.DEFAULT_PADDING))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,106 @@
+import os
+import pickle
+import argparse
+
+import assemble
+import expstruct
+import objtree
+import spriteidx
+import ptimer
+
+CACHE_VERSION = 3
+CACHE_FILE_NAME = 'character.pickle'
+
+class Character:
+    """
+    编译后的角色数据：导出结构（含材质表）、数组形式的对象树（已预先计算全局位置）、
+    compositionMap所在组件及其闭包表与Sprite索引，可直接用于合成
+    """
+    def __init__(self, export_struct: expstruct.ExportStructure, tree: objtree.FlatTree,
+                 composition_component: dict, sprite_index: spriteidx.SpriteIndex):
+        self.export_struct = export_struct
+        self.tree = tree
+        self.composition_component = composition_component
+        self.composition = assemble.CompositionTable(self.composition_map, tree).compile()
+        self.sprite_index = sprite_index
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.export_struct.prefab_path).split('.')[0]
+
+    @property
+    def composition_map(self) -> list:
+        return self.composition_component['MonoBehaviour']['compositionMap']
+
+def _source_stamp(export_dir) -> dict:
+    """编译结果所依赖的源文件（及其所在目录）的mtime与大小"""
+    asset_dir = os.path.join(export_dir, 'ExportedProject', 'Assets')
+    watched = [
+        (os.path.join(asset_dir, 'Texture2D'), None),
+        (os.path.join(asset_dir, 'Sprite'), '.asset'),
+        (os.path.join(asset_dir, '#WitchTrials', 'Prefabs', 'Naninovel', 'Characters', 'LayeredCharacters'), '.prefab'),
+        (os.path.join(asset_dir, 'Material'), '.meta'),
+    ]
+    stamp = {}
+    for directory, suffix in watched:
+        stat = os.stat(directory)
+        stamp[directory] = (stat.st_mtime_ns, 0)
+        if suffix is None:
+            continue
+        for entry in os.scandir(directory):
+            if entry.name.endswith(suffix):
+                stat = entry.stat()
+                stamp[entry.path] = (stat.st_mtime_ns, stat.st_size)
+    return stamp
+
+def compile_character(export_dir) -> Character:
+    export_struct = expstruct.analyse_export_structure(export_dir)
+    with ptimer.span('parse.prefab'):
+        prefab_data = assemble.parse_prefab(export_struct.prefab_path)
+    with ptimer.span('parse.objtree'):
+        objtree_root, node_map = objtree.build_tree(prefab_data)
+        composition_component = assemble.get_composition_component(prefab_data, objtree_root)
+        tree = objtree.flatten_tree(objtree_root, node_map)
+    with ptimer.span('parse.sprite_index'):
+        sprite_index = spriteidx.load_sprite_index(export_struct)
+    with ptimer.span('parse.composition'):
+        return Character(export_struct, tree, composition_component, sprite_index)
+
+def load_character(export_dir, use_cache: bool=True, rebuild: bool=False) -> Character:
+    """读取编译缓存，源文件有变化（或缓存不可用）时重新编译并写回"""
+    cache_path = os.path.join(expstruct.get_cache_dir(export_dir), CACHE_FILE_NAME)
+    stamp = _source_stamp(export_dir)
+
+    if use_cache and not rebuild and os.path.exists(cache_path):
+        try:
+            with ptimer.span('parse.cache'), open(cache_path, 'rb') as f:
+                cached = pickle.load(f)
+            if cached['version'] == CACHE_VERSION and cached['stamp'] == stamp:
+                return cached['character']
+        except Exception as e:
+            print(f"\033[33mWarning: Ignoring unreadable character cache {cache_path}: {e}\033[0m")
+
+    with ptimer.span('parse.compile'):
+        character = compile_character(export_dir)
+    if use_cache:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'stamp': stamp, 'character': character}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return character
+
+def main():
+    parser = argparse.ArgumentParser(description="编译角色数据并写入缓存")
+    parser.add_argument('-d', '--dir', type=str, help='解包文件路径，应为ExportedProject的上级目录')
+    parser.add_argument('-f', '--force', help='忽略已有缓存，强制重新编译', action='store_true')
+    args = parser.parse_args()
+
+    # 通过模块名调用，使缓存中的Character可以被其他脚本反序列化（而不是记为__main__.Character）
+    import charcache
+
+    timer = ptimer.Timer()
+    character = charcache.load_character(args.dir, rebuild=args.force)
+    timer.checkpoint("Character loading")
+    print(f"Character: {character.name}, nodes: {len(character.tree)}, sprites: {len(character.sprite_index.entries)}")
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,104 @@ import argparse
 import os
 import json
 import yaml
+from itertools import product
 
-import assemble
-import expstruct
-import objtree
+import charcache
+
+def top_level_keys(composition_map: list) -> list[str]:
+    """compositionMap中没有作为其他键的子项出现过的键，按出现顺序"""
+    sub_items = set()
+    for item in composition_map:
+        for sub_item in item['Composition'].split(','):
+            sub_items.add(sub_item.rstrip('+-'))
+    return [item['Key'] for item in composition_map if item['Key'] not in sub_items]
+
+def composition_groups(character: charcache.Character, keys: list[str]) -> list[list[str]]:
+    """
+    按闭包涉及的节点名把键分组：直接或间接涉及同一节点（相互覆盖）的键属于同一组，
+    同组的键在一个组合中只取其一；组与组内的键均按出现顺序
+    """
+    group_of = {}   # 节点名或键 -> 并查集的父元素
+    def find(item):
+        while group_of.setdefault(item, item) != item:
+            group_of[item] = group_of[group_of[item]]
+            item = group_of[item]
+        return item
+
+    for key in keys:
+        for node_name in character.composition.closure(key):
+            group_of[find(('node', node_name))] = find(key)
+
+    groups = {}
+    for key in keys:
+        groups.setdefault(find(key), []).append(key)
+    return list(groups.values())
+
+def enumerate_combinations(character: charcache.Character, default_appearance: list[str], groups: list[list[str|None]],
+                           optional: bool=False) -> list[list[str]]:
+    """
+    以default_appearance为基础，对各组的候选键做笛卡尔积：与某个默认键涉及相同节点的组替换该默认键的位置，
+    否则追加在末尾；候选键为None表示保留默认键（追加的组则不取任何键），optional为True时追加的组自动加入该选项
+    """
+    def node_names(keys):
+        names = set()
+        for key in keys:
+            try:
+                names.update(character.composition.closure(key) if key is not None else ())
+            except (AssertionError, ValueError):
+                pass    # 无效的键在deduplicate_combinations中报告
+        return names
+
+    slots = []      # 各组在default_appearance中替换的位置，None为追加
+    options = []
+    taken = set()
+    for group in groups:
+        names = node_names(group)
+        slot = next((i for i, key in enumerate(default_appearance)
+                     if i not in taken and names & node_names([key])), None)
+        if slot is not None:
+            taken.add(slot)
+        elif optional and None not in group:
+            group = [None] + group
+        slots.append(slot)
+        options.append(group)
+
+    combinations = []
+    for choice in product(*options):
+        keys = list(default_appearance)
+        appended = []
+        for slot, key in zip(slots, choice):
+            if slot is None:
+                appended.append(key)
+            elif key is not None:
+                keys[slot] = key
+        combinations.append([key for key in keys + appended if key is not None])
+    return combinations
+
+def deduplicate_combinations(character: charcache.Character, combinations: list[list[str]]) -> tuple[list[list[str]], list[dict]]:
+    """
+    把每个组合解析为最终的节点列表（先序下标，本身即有序），图层集合相同的组合只合成第一个；
+    返回 (需要合成的组合, 清单)，清单记录每个有效组合对应的合成组合
+    """
+    canonical = {}  # tuple(节点下标) -> 需要合成的组合
+    manifest = []
+    for keys in combinations:
+        try:
+            node_list = tuple(character.composition.resolve(keys))
+        except (AssertionError, ValueError) as e:
+            print(f"\033[33mWarning: Skipping invalid composition {keys}: {e}\033[0m")
+            continue
+        if not node_list:
+            continue
+        manifest.append({'keys': keys, 'figure': canonical.setdefault(node_list, keys)})
+    return list(canonical.values()), manifest
 
 def main(arglist=None):
     parser = argparse.ArgumentParser(description="生成配置文件")
     parser.add_argument('-d', '--dir', type=str, help='解包文件路径，应为ExportedProject的上级目录')
     parser.add_argument('-o', '--output', type=str, help='配置文件输出目录', default='./configs')
+    parser.add_argument('-e', '--enumerate', help='枚举compositionMap各组键的全部组合，图层相同的组合只合成一次', action='store_true')
+    parser.add_argument('-g', '--group', type=str, action='append', help='只枚举指定的组合：每次给出一组逗号分隔的候选键（空项表示保留默认键或不取），各组做笛卡尔积，可重复使用')
 
     if arglist is not None:
         args = arglist
@@ -20,10 +109,9 @@ def main(arglist=None):
     config = {}
     config['export_dir'] = args.dir
 
-    export_struct = expstruct.analyse_export_structure(args.dir)
-    prefab_data = assemble.parse_prefab(export_struct.prefab_path)
-    objtree_root, node_map = objtree.build_tree(prefab_data)
-    composition_component = assemble.get_composition_component(prefab_data, objtree_root)
+    character = charcache.load_character(args.dir)
+    export_struct = character.export_struct
+    composition_component = character.composition_component
 
     # 获取output_dir_figure和output_dir_sprite
     character_name = os.path.basename(export_struct.prefab_path).split('.')[0]
@@ -55,6 +143,17 @@ def main(arglist=None):
     print(f"Remaining keys: {key_set}")
     config['composite_keys_list'] = [default_appearance[:-1] + [key] for key in key_set ]
 
+    groups = [[key or None for key in group.split(',')] for group in getattr(args, 'group', None) or []]
+    if groups or getattr(args, 'enumerate', False):
+        optional = not groups
+        if not groups:
+            groups = composition_groups(character, top_level_keys(composition_map))
+        combinations = enumerate_combinations(character, default_appearance, groups, optional)
+        config['composite_keys_list'], config['composite_manifest'] = deduplicate_combinations(character, combinations)
+        print(f"Groups: {groups}")
+        print(f"\033[34m{len(config['composite_manifest'])} valid combinations of {len(combinations)}, "
+              f"{len(config['composite_keys_list'])} distinct figures\033[0m")
+
     output = json.dumps(config, indent=4)
     output_path = os.path.join(args.output, f"{character_name}_config.json")
     os.makedirs(os.path.dirname(output_path), exist_ok=True)  # 创建目录
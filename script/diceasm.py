@@ -2,16 +2,21 @@ import yaml
 import argparse
 import numpy as np
 from PIL import Image
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 import os
+import time
+import binascii
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
-from breakup import ImageCropper
+from breakup import ImageCropper, share_texture_array, attach_texture_array
+import imgwriter
 import ptimer
 
 image_cropper = None
 
 @dataclass
 class MeshSquare:
+    """单个矩形网格，vertices_to_mesh_square返回的(M, 8)数组按以下字段顺序排列"""
     # Bottom-left corner
     minx: float
     miny: float
@@ -39,164 +44,356 @@ class ImagePaster:
     def image(self):
         return Image.fromarray(self.canvas_array)
 
-def assemble_vertices(mesh_square_list: list[MeshSquare]):
-    texture_width, texture_height = image_cropper.get_size()
-
-    max_x = max(mesh.maxx for mesh in mesh_square_list)
-    min_x = min(mesh.minx for mesh in mesh_square_list)
-    max_y = max(mesh.maxy for mesh in mesh_square_list)
-    min_y = min(mesh.miny for mesh in mesh_square_list)
+def plan_mesh_squares(mesh_squares: np.ndarray, texture_size: tuple):
+    """
+    计算画布尺寸与每个矩形的整数坐标：
+    返回 (canvas_width, canvas_height, positions, rects)，
+    positions为(M, 2)的画布左上角坐标，rects为(M, 4)的纹理矩形 x, y, width, height（同m_Rect，y轴向上）
+    """
+    texture_width, texture_height = texture_size
+    minx, miny, minu, minv, maxx, maxy, maxu, maxv = mesh_squares.T
+
+    max_x = maxx.max()
+    min_x = minx.min()
+    max_y = maxy.max()
+    min_y = miny.min()
     canvas_width = round((max_x - min_x) * 100)
     canvas_height = round((max_y - min_y) * 100)
     offset_x = -min_x
     offset_y = -min_y
 
-    def mesh_to_texture_rect(mesh: MeshSquare):
-        texture_x = round(mesh.minu * texture_width)
-        texture_y = round(mesh.minv * texture_height)
-        width = round((mesh.maxu - mesh.minu) * texture_width) 
-        height = round((mesh.maxv - mesh.minv) * texture_height)
-        return {'x': texture_x, 'y': texture_y, 'width': width, 'height': height}
-
-    canvas_positions = []
-    cropper_rects = []
-    for mesh in mesh_square_list:
-        canvas_x = round((mesh.minx + offset_x) * 100)
-        canvas_y = round(canvas_height - (mesh.maxy + offset_y) * 100)
-        canvas_positions.append( (canvas_x, canvas_y) )
-        rect = mesh_to_texture_rect(mesh)
-        cropper_rects.append(rect)
-
-    # print(f"canvas positions: {canvas_positions}")
-    # print(f"cropper rects: {cropper_rects}")
-    # print(f"Canvas size: {canvas_width}x{canvas_height}")
-    # print(f"len of cropper_rects: {len(cropper_rects)}, len of canvas_positions: {len(canvas_positions)}")
-
-    timer = ptimer.Timer()
-    image_paster = ImagePaster(canvas_width, canvas_height)
-
-    for position, rect in zip(canvas_positions, cropper_rects):
+    positions = np.stack([
+        np.round((minx + offset_x) * 100),
+        np.round(canvas_height - (maxy + offset_y) * 100)], axis=1).astype(np.int64)
+    rects = np.stack([
+        np.round(minu * texture_width),
+        np.round(minv * texture_height),
+        np.round((maxu - minu) * texture_width),
+        np.round((maxv - minv) * texture_height)], axis=1).astype(np.int64)
+    return canvas_width, canvas_height, positions, rects
+
+def paste_quads_loop(image_paster: ImagePaster, positions: np.ndarray, rects: np.ndarray):
+    """逐个矩形裁剪并粘贴，作为参考实现"""
+    texture_width, texture_height = image_cropper.get_size()
+    for position, (x, y, width, height) in zip(positions.tolist(), rects.tolist()):
+        rect = {'x': x, 'y': y, 'width': width, 'height': height}
         if not (rect['x'] + rect['width'] <= texture_width 
                 and rect['y'] + rect['height'] <= texture_height 
                 and rect['x'] >= 0 
                 and rect['y'] >= 0):
             print(f"\033[33mWarning: Crop rectangle {rect} exceeds texture size {texture_width}x{texture_height}.\033[0m")
         cropped_image_array = image_cropper.crop_array(rect)
-        image_paster.paste(cropped_image_array, position)
+        image_paster.paste(cropped_image_array, tuple(position))
+
+def _row_windows(array: np.ndarray, width: int, writeable: bool=False) -> np.ndarray:
+    """
+    (H, W) -> (H, W - width + 1)的视图，[row, col]为从(row, col)起长为width的一段像素，
+    整段视为一个void元素，fancy indexing时按段整体复制
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(array, width, axis=1, writeable=writeable)
+    return windows.view(np.dtype((np.void, width * array.itemsize)))[..., 0]
+
+def _rects_overlap(x: np.ndarray, y: np.ndarray, width: np.ndarray, height: np.ndarray, max_pairs: int) -> bool:
+    """
+    矩形（像素坐标）两两之间是否有重叠：按最大矩形尺寸划分网格，重叠的两个矩形所在格子在两个方向上最多相差1，
+    只需比较同一格与右、下方相邻格中的矩形对；候选对数超过max_pairs时保守地返回True
+    """
+    cell_width, cell_height = int(width.max()), int(height.max())
+    cell_x = x // cell_width + 1     # 左右各留一列，邻格的键不会跨行
+    cell_y = y // cell_height
+    row_length = int(cell_x.max()) + 2
+    keys = cell_y * row_length + cell_x
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    x, y, width, height = x[order], y[order], width[order], height[order]
+
+    candidates = []
+    total = 0
+    for offset in (0, 1, row_length - 1, row_length, row_length + 1):
+        target = keys + offset
+        low = np.arange(1, len(keys) + 1) if offset == 0 else np.searchsorted(keys, target, 'left')
+        high = np.searchsorted(keys, target, 'right')
+        counts = np.maximum(high - low, 0)
+        total += int(counts.sum())
+        if total > max_pairs:
+            return True
+        candidates.append((low, counts))
+
+    for low, counts in candidates:
+        first = np.repeat(np.arange(len(keys)), counts)
+        second = np.repeat(low - np.cumsum(counts) + counts, counts) + np.arange(int(counts.sum()))
+        if np.any((x[first] < x[second] + width[second]) & (x[second] < x[first] + width[first])
+                  & (y[first] < y[second] + height[second]) & (y[second] < y[first] + height[first])):
+            return True
+    return False
+
+# 小于该面积（像素）的矩形按组gather/scatter，更大的矩形逐个切片复制更快；组内矩形过少时同样逐个复制
+BATCHED_MAX_TILE_AREA = 512
+BATCHED_MIN_GROUP_SIZE = 16
+# 矩形总数少于此值时分组与重叠检测的固定开销超过收益，直接逐个粘贴
+BATCHED_MIN_QUADS = 400
+
+def paste_quads_batched(image_paster: ImagePaster, positions: np.ndarray, rects: np.ndarray):
+    """
+    按矩形尺寸分组，小矩形的组用一次以“行段”为单位的gather/scatter完成粘贴，其余逐个切片复制；
+    存在越界（需要原有的警告与切片语义）或重叠（粘贴顺序会影响结果）的矩形时，整体交给paste_quads_loop
+    """
+    texture_array = image_cropper.image_array
+    canvas_array = image_paster.canvas_array
+    texture_height, texture_width = texture_array.shape[0:2]
+    if len(rects) < BATCHED_MIN_QUADS or texture_array.ndim != 3 or texture_array.shape[2] != 4 or not texture_array.flags.c_contiguous:
+        return paste_quads_loop(image_paster, positions, rects)
+
+    x, y, width, height = rects.T
+    canvas_x, canvas_y = positions.T
+    inside = ((x >= 0) & (y >= 0) & (x + width <= texture_width) & (y + height <= texture_height)
+              & (canvas_x >= 0) & (canvas_y >= 0)
+              & (canvas_x + width <= image_paster.width) & (canvas_y + height <= image_paster.height)
+              & (width > 0) & (height > 0))
+    if not inside.all():
+        return paste_quads_loop(image_paster, positions, rects)
+
+    # 矩形之间有重叠时结果依赖粘贴顺序，退回逐个粘贴
+    if _rects_overlap(canvas_x, canvas_y, width, height, max_pairs=8 * len(rects)):
+        return paste_quads_loop(image_paster, positions, rects)
+
+    # 纹理行号：m_Rect的y轴向上，数组行向下
+    source_top = texture_height - y - height
+    # RGBA像素视为一个uint32
+    texture_pixels = texture_array.view(np.uint32)[:, :, 0]
+    canvas_pixels = canvas_array.view(np.uint32)[:, :, 0]
+
+    # 一次排序完成按尺寸分组
+    order = np.lexsort((width, height))
+    sizes = np.stack([height[order], width[order]], axis=1)
+    starts = np.flatnonzero(np.any(sizes[1:] != sizes[:-1], axis=1)) + 1
+    singles = []
+    for index in np.split(order, starts):
+        group_height, group_width = int(height[index[0]]), int(width[index[0]])
+        if group_height * group_width > BATCHED_MAX_TILE_AREA or len(index) < BATCHED_MIN_GROUP_SIZE:
+            singles.append(index)
+            continue
+        rows = np.arange(group_height)
+        tiles = _row_windows(texture_pixels, group_width)[source_top[index, None] + rows, x[index, None]]   # (k, h)个行段
+        _row_windows(canvas_pixels, group_width, writeable=True)[canvas_y[index, None] + rows, canvas_x[index, None]] = tiles
+
+    if singles:
+        index = np.concatenate(singles)
+        for left, top, source_left, source_top_row, tile_width, tile_height in zip(
+                canvas_x[index].tolist(), canvas_y[index].tolist(), x[index].tolist(), source_top[index].tolist(),
+                width[index].tolist(), height[index].tolist()):
+            canvas_pixels[top:top + tile_height, left:left + tile_width] = \
+                texture_pixels[source_top_row:source_top_row + tile_height, source_left:source_left + tile_width]
+
+_PASTE_ENGINES = {
+    'batched': paste_quads_batched,
+    'loop': paste_quads_loop,
+}
+
+def assemble_vertices(mesh_squares: np.ndarray, engine: str='loop'):
+    """mesh_squares: vertices_to_mesh_square返回的(M, 8)数组；engine: 'batched'或'loop'"""
+    canvas_width, canvas_height, positions, rects = plan_mesh_squares(mesh_squares, image_cropper.get_size())
+
+    # print(f"Canvas size: {canvas_width}x{canvas_height}")
+
+    timer = ptimer.Timer()
+    image_paster = ImagePaster(canvas_width, canvas_height)
+    _PASTE_ENGINES[engine](image_paster, positions, rects)
 
     timer.checkpoint("Finished assembling meshes")
     return image_paster.image()
 
-def list_to_points(list):
-    points = []
-    for i in range(0, len(list) - 1, 2):
-        x = list[i]
-        y = list[i+1]
-        points.append( (x, y) )
-    return points
-
-def str_to_float_list(string, width, start_index=None, end_index=None, padding_per=None):
-    floats_num = []
+def decode_float_array(string, start_index=None, end_index=None, padding_per=None) -> np.ndarray:
+    """
+    一次性把十六进制字符串解码为float32数组；padding_per不为None时，
+    每padding_per个值后跟一个须为0的填充值（按全局下标计），解码后去掉
+    """
     start = start_index if start_index is not None else 0
     end = end_index if end_index is not None else len(string)
-
-    for i in range(start, end, width):
-        hex_str = string[i:i+width]
-        if padding_per is not None and (i / width + 1) % (padding_per + 1) == 0:
-            assert hex_str == '00000000', f"Expected padding zeros at index {i}, got {hex_str}"
-            # print(f"\033[33mSkipping padding at index {i}: {hex_str}\033[0m")
-            continue
-        float_value = np.frombuffer(bytes.fromhex(hex_str), dtype=np.float32)[0]
-        floats_num.append(float_value)
-    return floats_num
-
-def analyse_mesh_vertices(yaml_data):
+    raw = binascii.unhexlify(string[start:end])   # 同时接受str、bytes与memoryview
+    values = np.frombuffer(raw, dtype='<f4', count=len(raw) // 4)
+    if padding_per is None:
+        return values
+    is_padding = (np.arange(len(values)) + start // 8 + 1) % (padding_per + 1) == 0
+    padding = values.view('<u4')[is_padding]
+    if padding.any():
+        bad_index = (np.flatnonzero(is_padding)[np.flatnonzero(padding)[0]] + start // 8) * 8
+        raise AssertionError(f"Expected padding zeros at index {bad_index}, got {bytes(string[bad_index:bad_index + 8])}")
+    return values[~is_padding]
+
+def _scan_vertex_data(asset_path):
+    """
+    直接在原始字节中定位m_SubMeshes[0].vertexCount与m_VertexData._typelessdata，
+    不构建YAML对象；返回 (十六进制数据的memoryview, vertex_count)，布局不符合预期时返回None
+    """
+    with open(asset_path, 'rb') as f:
+        content = f.read()
+
+    sub_meshes = content.find(b'\n    m_SubMeshes:\n')
+    vertex_data = content.find(b'\n    m_VertexData:\n')
+    if sub_meshes < 0 or vertex_data < sub_meshes:
+        return None
+
+    count_key = content.find(b'vertexCount:', sub_meshes, vertex_data)
+    if count_key < 0:
+        return None
+    count_end = content.find(b'\n', count_key)
+    try:
+        vertex_count = int(content[count_key + len(b'vertexCount:'):count_end])
+    except ValueError:
+        return None
+
+    data_key = content.find(b'\n      _typelessdata: ', vertex_data)
+    if data_key < 0:
+        return None
+    data_start = data_key + len(b'\n      _typelessdata: ')
+    data_end = content.find(b'\n', data_start)
+    if data_end < 0:
+        data_end = len(content)
+    data = memoryview(content)[data_start:data_end]
+    # 折行或带引号的标量交给YAML处理
+    if content[data_end + 1:data_end + 8].startswith(b'       ') or len(data) % 8 != 0 or not bytes(data[:8]).isalnum():
+        return None
+    return data, vertex_count
+
+def read_vertex_data(asset_path):
+    """返回 (_typelessdata, vertexCount)，扫描失败时回退到完整的YAML解析"""
+    scanned = _scan_vertex_data(asset_path)
+    if scanned is not None:
+        return scanned
+    with open(asset_path, 'r') as file:
+        content = ''.join(file.readlines()[3:])
+        yaml_data = yaml.safe_load(content)
+    return (yaml_data['Sprite']['m_RD']['m_VertexData']['_typelessdata'],
+            yaml_data['Sprite']['m_RD']['m_SubMeshes'][0]['vertexCount'])
+
+def analyse_mesh_vertices(yaml_data) -> np.ndarray:
+    """返回(N, 4)的float32数组，列依次为x, y, u, v"""
     _typeless_data = yaml_data['Sprite']['m_RD']['m_VertexData']['_typelessdata']
     vertex_count = yaml_data['Sprite']['m_RD']['m_SubMeshes'][0]['vertexCount']
+    return decode_mesh_vertices(_typeless_data, vertex_count)
 
+def decode_mesh_vertices(_typeless_data, vertex_count: int) -> np.ndarray:
     border_index = vertex_count * 8 * 3
 
-    xy_points = list_to_points(str_to_float_list(_typeless_data, 8, end_index=border_index, padding_per=2))
-    uv_points = list_to_points(str_to_float_list(_typeless_data, 8, start_index=border_index))
-    print(f"border: {vertex_count}, xy points count: {len(xy_points)}, uv points count: {len(uv_points)}")
-
-    assert len(xy_points) == vertex_count, f"Expected {vertex_count} xy points, got {len(xy_points)}"
-    assert len(uv_points) == vertex_count, f"Expected {vertex_count} uv points, got {len(uv_points)}"
-
-    mesh_vertices = []
-    for xy, uv in zip(xy_points, uv_points):
-        mesh_vertices.append( {
-            'x': xy[0],
-            'y': xy[1],
-            'u': uv[0],
-            'v': uv[1],
-        })
-
-    return mesh_vertices
-
-def vertices_to_mesh_square(mesh_vertices):
-    mesh_square_list = []
-
-    for i in range(0, len(mesh_vertices), 4):
-        # Left-bottom corner
-        minx = min([v['x'] for v in mesh_vertices[i:i+4]])
-        miny = min([v['y'] for v in mesh_vertices[i:i+4]])
-        minu = min([v['u'] for v in mesh_vertices[i:i+4]])
-        minv = min([v['v'] for v in mesh_vertices[i:i+4]])
-        # Right-top corner
-        maxx = max([v['x'] for v in mesh_vertices[i:i+4]])
-        maxy = max([v['y'] for v in mesh_vertices[i:i+4]])
-        maxu = max([v['u'] for v in mesh_vertices[i:i+4]])
-        maxv = max([v['v'] for v in mesh_vertices[i:i+4]])
-                                                   
-        # assert maxx - minx < 0.65 and maxy - miny < 0.65 and maxv - minv < 1/52 and maxu - minu < 1/44, f"Quad too large: x range {maxx - minx}, y range {maxy - miny}"
-
-        mesh_square = MeshSquare(
-            minx=minx,
-            miny=miny,
-            minu=minu,
-            minv=minv,
-            maxx=maxx,
-            maxy=maxy,
-            maxu=maxu,
-            maxv=maxv,
-        )
-        # assert mesh_square not in mesh_square_list, f"Duplicate square vertex at {mesh_square}"
-        mesh_square_list.append(mesh_square)
-
-    return mesh_square_list
+    xy_values = decode_float_array(_typeless_data, end_index=border_index, padding_per=2)
+    uv_values = decode_float_array(_typeless_data, start_index=border_index)
+    print(f"border: {vertex_count}, xy points count: {len(xy_values) // 2}, uv points count: {len(uv_values) // 2}")
+
+    assert len(xy_values) // 2 == vertex_count, f"Expected {vertex_count} xy points, got {len(xy_values) // 2}"
+    assert len(uv_values) // 2 == vertex_count, f"Expected {vertex_count} uv points, got {len(uv_values) // 2}"
+
+    return np.hstack([xy_values[:vertex_count * 2].reshape(-1, 2), uv_values[:vertex_count * 2].reshape(-1, 2)])
+
+def vertices_to_mesh_square(mesh_vertices: np.ndarray) -> np.ndarray:
+    """每4个顶点组成一个矩形，返回(M, 8)数组，列顺序同MeshSquare的字段"""
+    quads = mesh_vertices[:len(mesh_vertices) // 4 * 4].reshape(-1, 4, 4)
+    # assert maxx - minx < 0.65 and maxy - miny < 0.65 and maxv - minv < 1/52 and maxu - minu < 1/44, f"Quad too large: x range {maxx - minx}, y range {maxy - miny}"
+    return np.hstack([quads.min(axis=1), quads.max(axis=1)])
+
+def benchmark_engines(mesh_squares: np.ndarray, repeat: int=3):
+    """对同一组矩形分别运行各粘贴引擎，取最短耗时并校验结果一致"""
+    canvas_width, canvas_height, positions, rects = plan_mesh_squares(mesh_squares, image_cropper.get_size())
+    best = {}
+    results = {}
+    for engine, paste in _PASTE_ENGINES.items():
+        for _ in range(repeat):
+            image_paster = ImagePaster(canvas_width, canvas_height)
+            start = time.perf_counter()
+            paste(image_paster, positions, rects)
+            elapsed = time.perf_counter() - start
+            best[engine] = min(best.get(engine, elapsed), elapsed)
+        results[engine] = image_paster.canvas_array
+        print(f"\033[32m{engine} engine took {best[engine] * 1000:.1f} ms for {len(mesh_squares)} quads.\033[0m")
+    distinct_sizes = len(np.unique(rects[:, 2:4], axis=0))
+    identical = np.array_equal(results['batched'], results['loop'])
+    print(f"\033[34mDistinct tile sizes: {distinct_sizes}, speedup: {best['loop'] / best['batched']:.1f}x, identical output: {identical}\033[0m")
+
+def process_asset(asset_file, output_dir, engine: str='loop', benchmark: bool=False, writer: imgwriter.ImageWriter=None) -> str:
+    """解析、重组一个切块Sprite资产并交给writer保存（默认同步写入PNG），返回输出路径"""
+    mesh_vertices = decode_mesh_vertices(*read_vertex_data(asset_file))
+
+    mesh_squares = vertices_to_mesh_square(mesh_vertices)
+    print(f"mesh square count: {len(mesh_squares)}")
+
+    if benchmark:
+        benchmark_engines(mesh_squares)
+
+    result = assemble_vertices(mesh_squares, engine)
+    # result.show()
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, os.path.basename(asset_file).replace('.asset', '.png'))
+    if writer is None:
+        writer = imgwriter.ImageWriter(imgwriter.WriterOptions(threads=0))
+    output_path = writer.submit(result, output_path)
+    print(f"\033[34mAssembled image queued for {output_path}\033[0m")
+    return output_path
+
+# 并行模式下子进程映射的共享纹理
+_worker_texture_shm = None
+
+def _init_asset_worker(texture_descriptor):
+    global image_cropper, _worker_texture_shm
+    _worker_texture_shm, texture_array = attach_texture_array(texture_descriptor)
+    image_cropper = ImageCropper.from_array(texture_array)
+
+def _process_asset_task(asset_file, output_dir, engine: str, writer_options: imgwriter.WriterOptions) -> str:
+    # 进程池本身已经并行，子进程内同步写入
+    return process_asset(asset_file, output_dir, engine, writer=imgwriter.ImageWriter(replace(writer_options, threads=0)))
+
+def process_assets_parallel(asset_files: list, output_dir, engine: str, jobs: int, max_in_flight: int=None,
+                            writer_options: imgwriter.WriterOptions=imgwriter.WriterOptions()) -> list[str]:
+    """
+    多进程处理切块资产：纹理只在父进程解码一次并放入共享内存，
+    同时提交的任务数不超过max_in_flight（默认为进程数的2倍），其余资产按完成情况依次提交
+    """
+    max_in_flight = max_in_flight or jobs * 2
+    texture_shm, texture_descriptor = share_texture_array(image_cropper.image_array)
+    output_paths = []
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_asset_worker, initargs=(texture_descriptor,)) as executor:
+            pending = set()
+            for asset_file in asset_files:
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    output_paths.extend(future.result() for future in done)
+                pending.add(executor.submit(_process_asset_task, asset_file, output_dir, engine, writer_options))
+            output_paths.extend(future.result() for future in as_completed(pending))
+    finally:
+        texture_shm.close()
+        texture_shm.unlink()
+    return output_paths
 
 def main(arglist=None):
     parser = argparse.ArgumentParser(description="Parse a YAML file.")
-    parser.add_argument("-f", "--file", type=str, required=True, help="Path to the YAML file to parse.")
+    parser.add_argument("-f", "--file", type=str, nargs='+', required=True, help="Path(s) to the diced sprite .asset file(s) to parse.")
     parser.add_argument("-t", "--texture", type=str, required=True, help="Path to the texture file.")
     parser.add_argument("-o", "--output", type=str, required=True, help="Path to save the output image.")
+    parser.add_argument("-c", "--cache-dir", type=str, default=None, help="Directory for the memory-mapped raw texture cache; decode every run if omitted.")
+    parser.add_argument("-e", "--engine", type=str, choices=list(_PASTE_ENGINES), default='loop', help="Paste engine: the per-quad loop (default), or grouped gather/scatter, which only pays off for many small tiles.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes for multiple assets.")
+    parser.add_argument("-b", "--benchmark", action='store_true', help="Time both paste engines on each asset and check that their outputs match.")
+    imgwriter.add_arguments(parser)
 
     if arglist is not None:
         args = arglist
     else:
         args = parser.parse_args()
-        args.file = [args.file]
 
     global image_cropper
-    image_cropper = ImageCropper(args.texture)
+    image_cropper = ImageCropper(args.texture, getattr(args, 'cache_dir', None))
 
-    for asset_file in args.file:
-        with open(asset_file, 'r') as file:
-            content = ''.join(file.readlines()[3:])
-            data = yaml.safe_load(content)
-
-        mesh_vertices = analyse_mesh_vertices(data)
-
-        mesh_square_list = vertices_to_mesh_square(mesh_vertices)
-        print(f"mesh square count: {len(mesh_square_list)}")
-
-        result = assemble_vertices(mesh_square_list)
-        # result.show()
-        os.makedirs(args.output, exist_ok=True)
-        output_path = os.path.join(args.output, os.path.basename(asset_file).replace('.asset', '.png'))
-        result.save(output_path)
-        print(f"\033[34mSaved assembled image to {output_path}\033[0m")
+    engine = getattr(args, 'engine', 'loop')
+    jobs = getattr(args, 'jobs', 1) or 1
+    writer_options = imgwriter.options_from_args(args)
+    timer = ptimer.Timer()
+    if jobs > 1 and len(args.file) > 1 and not getattr(args, 'benchmark', False):
+        process_assets_parallel(args.file, args.output, engine, min(jobs, len(args.file)), writer_options=writer_options)
+    else:
+        with imgwriter.ImageWriter(writer_options) as writer:
+            for asset_file in args.file:
+                process_asset(asset_file, args.output, engine, getattr(args, 'benchmark', False), writer)
+    timer.checkpoint(f"Assembling {len(args.file)} assets")
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,8 +2,16 @@ import argparse
 import os
 import yaml
 
+CACHE_DIR_NAME = '.cache'
+
+def get_cache_dir(export_dir):
+    """脚本生成的索引、缓存等文件统一存放在导出目录下"""
+    return os.path.join(export_dir, CACHE_DIR_NAME)
+
 class ExportStructure:
     def __init__(self):
+        self.export_dir = None
+        self.cache_dir = None
         self.texture_path = None
         self.sprite_path = {}   # sprite name to path
         self.prefab_path = None
@@ -28,6 +36,8 @@ def analyse_export_structure(export_dir):
     asset_dir = os.path.join(export_dir, 
     'ExportedProject', 'Assets')
     result = ExportStructure()
+    result.export_dir = export_dir
+    result.cache_dir = get_cache_dir(export_dir)
 
     texture_dir = os.path.join(asset_dir, 'Texture2D')
     texture_file = [f for f in os.listdir(texture_dir) if f.endswith('.png')][0]
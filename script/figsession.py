@@ -0,0 +1,179 @@
+import os
+import argparse
+from collections import OrderedDict
+
+import assemble
+import blend
+import breakup
+import charcache
+import ptimer
+
+DEFAULT_MAX_CHECKPOINTS = 4
+
+class FigureSession:
+    """
+    常驻的差分立绘合成会话，用于频繁切换表情的交互/服务场景：
+    画布固定为角色全部组件的包围盒，切换表情组或开关图层时，
+    只在变化图层覆盖的矩形内，从缓存的下层画布（checkpoint）开始重新混合其上的图层
+    """
+    def __init__(self, character: charcache.Character, composition_keys: list[str],
+                 engine: blend.BlendEngine=blend.BlendEngine.FLOAT32, max_checkpoints: int=DEFAULT_MAX_CHECKPOINTS,
+                 image_cropper: breakup.ImageCropper=None):
+        self.character = character
+        self.engine = engine
+        self.max_checkpoints = max_checkpoints
+        self.image_cropper = image_cropper or breakup.ImageCropper(character.export_struct.texture_path, character.export_struct.cache_dir)
+        self.bounds = assemble.get_canvas_bounds(character.tree.sprite_nodes(), character.tree)
+        self._sprites = {}                  # Sprite名 -> 裁剪后的RGBA数组
+        self._checkpoints = OrderedDict()   # 前缀长度 -> (前缀图层, ImageBlender)，LRU顺序
+        self._actions = character.composition.actions(composition_keys)    # 当前的 {节点名: 动作}
+        self.layers = ()
+
+        plan = self._plan(self._actions)
+        self._blender = blend.ImageBlender(plan.width, plan.height, engine=engine)
+        self._blend(self._blender, plan.layers)
+        self.layers = plan.layers
+
+    @property
+    def width(self) -> int:
+        return self._blender.width
+
+    @property
+    def height(self) -> int:
+        return self._blender.height
+
+    def _plan(self, actions: dict) -> assemble.FigurePlan:
+        character = self.character
+        composition_node_list = assemble.traverse_objtree(character.tree, actions)
+        composition_node_list.reverse()
+        plan = assemble.plan_layers(composition_node_list, character.tree, character.export_struct, self.bounds)
+        self._check_masks(plan.layers)
+        return plan
+
+    @staticmethod
+    def _check_masks(layers):
+        """与完整合成一致：每个apply_mask_key都须由更早的图层设置，否则抛出ValueError"""
+        mask_keys = set()
+        for layer in layers:
+            if layer.apply_mask_key is not None and layer.apply_mask_key not in mask_keys:
+                raise ValueError(f"Layer {layer.name} applies mask '{layer.apply_mask_key}' that no layer below sets")
+            if layer.set_mask_key is not None:
+                mask_keys.add(layer.set_mask_key)
+
+    def _sprite(self, layer: assemble.LayerOp):
+        if layer.name not in self._sprites:
+            m_rect = self.character.sprite_index.get_rect(layer.name)
+            self._sprites[layer.name] = self.image_cropper.crop_array(m_rect)
+        return self._sprites[layer.name]
+
+    def _layer_rect(self, layer: assemble.LayerOp) -> tuple:
+        sprite_height, sprite_width = self._sprite(layer).shape[0:2]
+        x, y = layer.position
+        return x, y, x + sprite_width, y + sprite_height
+
+    def _blend(self, image_blender: blend.ImageBlender, layers, clip_rect: tuple=None):
+        for layer in layers:
+            image_blender.blend(self._sprite(layer), layer.position, mode=layer.blend_mode,
+                                set_mask_key=layer.set_mask_key, apply_mask_key=layer.apply_mask_key, clip_rect=clip_rect)
+
+    def _checkpoint(self, layers: tuple, depth: int) -> blend.ImageBlender:
+        """返回混合了layers[:depth]的画布，从最近的有效checkpoint补齐后缓存"""
+        base_depth = 0
+        base = None
+        for cached_depth, (cached_layers, cached_blender) in self._checkpoints.items():
+            if base_depth < cached_depth <= depth and cached_layers == layers[:cached_depth]:
+                base_depth, base = cached_depth, cached_blender
+        if base is not None and base_depth == depth:
+            self._checkpoints.move_to_end(depth)
+            return base
+        if depth == 0:
+            return blend.ImageBlender(self.width, self.height, engine=self.engine)
+
+        image_blender = base.copy() if base is not None else blend.ImageBlender(self.width, self.height, engine=self.engine)
+        self._blend(image_blender, layers[base_depth:depth])
+        self._checkpoints.pop(depth, None)
+        self._checkpoints[depth] = (layers[:depth], image_blender)
+        while len(self._checkpoints) > self.max_checkpoints:
+            self._checkpoints.popitem(last=False)
+        return image_blender
+
+    def _refresh(self, actions: dict) -> tuple|None:
+        """
+        切换到actions并重新规划，只重绘变化的矩形，返回该矩形(left, top, right, bottom)，无变化时返回None；
+        规划无法合成时抛出ValueError，会话状态保持不变
+        """
+        new_layers = self._plan(actions).layers
+        old_layers = self.layers
+        if new_layers == old_layers:
+            self._actions = actions
+            return None
+
+        # 相同的底部前缀与顶部后缀之外的图层即为变化的图层
+        prefix = 0
+        while prefix < min(len(old_layers), len(new_layers)) and old_layers[prefix] == new_layers[prefix]:
+            prefix += 1
+        suffix = 0
+        while (suffix < min(len(old_layers), len(new_layers)) - prefix
+               and old_layers[-1 - suffix] == new_layers[-1 - suffix]):
+            suffix += 1
+        changed_layers = old_layers[prefix:len(old_layers) - suffix] + new_layers[prefix:len(new_layers) - suffix]
+
+        rects = [self._layer_rect(layer) for layer in changed_layers]
+        dirty_rect = (max(min(r[0] for r in rects), 0), max(min(r[1] for r in rects), 0),
+                      min(max(r[2] for r in rects), self.width), min(max(r[3] for r in rects), self.height))
+        if dirty_rect[0] >= dirty_rect[2] or dirty_rect[1] >= dirty_rect[3]:
+            self._actions, self.layers = actions, new_layers
+            return None
+
+        # 矩形内：恢复变化处之下的画布，再混合其上的全部图层
+        below = self._checkpoint(new_layers, prefix)
+        self._blender.copy_region_from(below, dirty_rect)
+        self._blend(self._blender, new_layers[prefix:], dirty_rect)
+        self._actions, self.layers = actions, new_layers
+        return dirty_rect
+
+    def set_keys(self, composition_keys: list[str]) -> tuple|None:
+        """替换整组composition_keys"""
+        return self._refresh(self.character.composition.actions(composition_keys))
+
+    def apply(self, *items: str) -> tuple|None:
+        """
+        应用composition项，与compositionMap中的写法相同并覆盖此前的同名动作，
+        例如 apply('Eyes>Eyes_Angry')、apply('Cheeks-')、apply('Smile')；
+        状态只保存每个节点的最终动作，不随调用次数增长
+        """
+        actions = dict(self._actions)
+        actions.update(self.character.composition.actions(items))
+        return self._refresh(actions)
+
+    def toggle(self, name: str, enabled: bool) -> tuple|None:
+        """显示或隐藏名为name的图层（及其子节点）"""
+        return self.apply(f"{name}{'+' if enabled else '-'}")
+
+    def image(self):
+        return self._blender.image()
+
+def main():
+    parser = argparse.ArgumentParser(description="以局部重绘的方式依次切换差分并保存结果")
+    parser.add_argument('-d', '--dir', type=str, help='解包文件路径，应为ExportedProject的上级目录')
+    parser.add_argument('-k', '--compositionKeys', type=str, nargs='+', help='初始的composition_keys')
+    parser.add_argument('-u', '--update', type=str, action='append', default=[], help='依次应用的composition项，多项以逗号分隔，可多次指定')
+    parser.add_argument('-o', '--output', type=str, default='output', help='输出文件夹路径')
+    parser.add_argument('-e', '--engine', type=str, choices=['float32', 'uint8'], default='float32', help='图层混合引擎')
+    args = parser.parse_args()
+
+    timer = ptimer.Timer()
+    character = charcache.load_character(args.dir)
+    session = FigureSession(character, args.compositionKeys, engine=blend.BlendEngine[args.engine.upper()])
+    timer.checkpoint("Session building")
+
+    os.makedirs(args.output, exist_ok=True)
+    for index, update in enumerate(args.update):
+        dirty_rect = session.apply(*update.split(','))
+        timer.checkpoint(f"Update {update} (dirty rect: {dirty_rect})")
+        output_path = os.path.join(args.output, f"{character.name}_session_{index}.png")
+        session.image().save(output_path)
+        print(f"\033[34mComposited figure saved at {output_path}\033[0m")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import numpy as np
+from PIL import Image
+
+import ptimer
+
+try:
+    import qoi as _qoi     # Pillow不支持写入QOI时的可选后端
+except ImportError:
+    _qoi = None
+
+# 输出格式 -> 扩展名
+FORMAT_EXTENSIONS = {
+    'png': '.png',
+    'webp': '.webp',
+    'qoi': '.qoi',
+}
+
+# PNG的zlib压缩策略（zlib.Z_DEFAULT_STRATEGY等），对应Pillow的compress_type
+PNG_STRATEGIES = {
+    'default': 0,
+    'filtered': 1,
+    'huffman': 2,
+    'rle': 3,
+    'fixed': 4,
+}
+
+@dataclass(frozen=True)
+class WriterOptions:
+    """
+    image_format: png / webp（无损） / qoi
+    compress_level: PNG的zlib等级0-9，或WebP无损的压缩力度0-100；None为库默认值
+    strategy: PNG的zlib压缩策略，见PNG_STRATEGIES
+    threads: 后台编码线程数，0为在调用线程中同步写入
+    max_pending: 已提交但尚未写完的图像数上限，超过时submit阻塞；None为threads的2倍
+    """
+    image_format: str = 'png'
+    compress_level: int|None = None
+    strategy: str = 'default'
+    threads: int = 2
+    max_pending: int|None = None
+
+def add_arguments(parser):
+    parser.add_argument('--format', type=str, choices=list(FORMAT_EXTENSIONS), default='png', help='输出图像格式，webp为无损WebP')
+    parser.add_argument('--compress-level', type=int, default=None, help='PNG的zlib压缩等级（0-9）或WebP无损的压缩力度（0-100），默认为库的默认值')
+    parser.add_argument('--png-strategy', type=str, choices=list(PNG_STRATEGIES), default='default', help='PNG的zlib压缩策略')
+    parser.add_argument('--writer-threads', type=int, default=2, help='后台编码写入图像的线程数，0为同步写入')
+
+def options_from_args(args) -> WriterOptions:
+    """从命令行参数（或run.py传入的配置对象）读取，缺少的项使用默认值"""
+    return WriterOptions(
+        image_format=getattr(args, 'format', 'png'),
+        compress_level=getattr(args, 'compress_level', None),
+        strategy=getattr(args, 'png_strategy', 'default'),
+        threads=getattr(args, 'writer_threads', 2),
+    )
+
+def _pillow_writes_qoi() -> bool:
+    Image.init()    # Image.SAVE在首次保存或init之前可能尚未注册全部格式
+    return 'QOI' in Image.SAVE
+
+def _save_qoi(image: Image.Image, path):
+    if _pillow_writes_qoi():
+        image.save(path, format='QOI')
+    elif _qoi is not None:
+        _qoi.write(path, np.asarray(image.convert('RGBA')))
+    else:
+        raise RuntimeError("QOI output requires Pillow with QOI write support or the 'qoi' package")
+
+def save_image(image: Image.Image, path, options: WriterOptions=WriterOptions()):
+    with ptimer.span('encode', format=options.image_format):
+        _encode_image(image, path, options)
+    ptimer.count('bytes_written', os.path.getsize(path) if isinstance(path, (str, os.PathLike)) else path.tell())
+
+def _encode_image(image: Image.Image, path, options: WriterOptions):
+    if options.image_format == 'png':
+        params = {'compress_type': PNG_STRATEGIES[options.strategy]} if options.strategy != 'default' else {}
+        if options.compress_level is not None:
+            params['compress_level'] = options.compress_level
+        image.save(path, format='PNG', **params)
+    elif options.image_format == 'webp':
+        params = {'quality': options.compress_level} if options.compress_level is not None else {}
+        image.save(path, format='WEBP', lossless=True, **params)
+    elif options.image_format == 'qoi':
+        _save_qoi(image, path)
+    else:
+        raise ValueError(f"Unsupported image format: {options.image_format}")
+
+class ImageWriter:
+    """
+    图像输出阶段：编码与写盘在后台线程中进行（Pillow编码时释放GIL），与下一张图像的合成重叠；
+    提交的图像在写完之前不应再被修改
+    """
+    def __init__(self, options: WriterOptions=WriterOptions()):
+        if options.image_format not in FORMAT_EXTENSIONS:
+            raise ValueError(f"Unsupported image format: {options.image_format}")
+        if options.image_format == 'qoi' and not _pillow_writes_qoi() and _qoi is None:
+            raise ValueError("QOI output requires Pillow with QOI write support or the 'qoi' package")
+        self.options = options
+        self.encode_seconds = 0.0      # 累计编码写入耗时（各线程之和）
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+        self._futures = []
+        if options.threads > 0:
+            self._executor = ThreadPoolExecutor(max_workers=options.threads)
+            self._slots = threading.BoundedSemaphore(options.max_pending or options.threads * 2)
+
+    def output_path(self, path) -> str:
+        """把path的扩展名替换为输出格式的扩展名"""
+        return os.path.splitext(path)[0] + FORMAT_EXTENSIONS[self.options.image_format]
+
+    def _write(self, image: Image.Image, path):
+        start = time.perf_counter()
+        try:
+            save_image(image, path, self.options)
+        finally:
+            with self._lock:
+                self.encode_seconds += time.perf_counter() - start
+            if self._slots is not None:
+                self._slots.release()
+
+    def submit(self, image: Image.Image, path) -> str:
+        """提交一张图像，返回实际输出路径；待写图像已达上限时阻塞（背压）"""
+        output_path = self.output_path(path)
+        if self._executor is None:
+            self._write(image, output_path)
+            return output_path
+        self._slots.acquire()
+        self._futures.append(self._executor.submit(self._write, image, output_path))
+        # 及早抛出已完成任务中的异常，并释放已完成的future
+        pending = []
+        for future in self._futures:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self._futures = pending
+        return output_path
+
+    def close(self):
+        """等待全部写入完成，有写入失败时抛出第一个异常"""
+        if self._executor is None:
+            return
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._futures = []
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._slots = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,5 +1,5 @@
-import assemble
 import argparse
+import numpy as np
 
 class Node:
     """
@@ -101,6 +101,155 @@ def build_tree(prefab_data: dict):
     # assert root is not None, "Root node not found"
     return root, node_map
 
+HAS_SPRITE = 1
+RENDER_ENABLED = 2
+
+class FlatTree:
+    """
+    数组形式的对象树，节点按先序（深度优先、子节点按m_Children顺序）编号，根节点为0：
+    节点i的子树占据连续的区间 [i, subtree_end[i])，其第一个子节点为i+1，下一个兄弟节点为subtree_end[i]；
+    全局位置在构建时按层一次性算出，整体可直接序列化缓存
+    """
+    def __init__(self, ids: list[str], names: list[str], parent: np.ndarray, subtree_end: np.ndarray, depth: np.ndarray,
+                 local_position: np.ndarray, sprite_size: np.ndarray, flags: np.ndarray, materials: list[tuple]):
+        self.ids = ids                          # 节点（Transform）的fileID
+        self.names = names
+        self.parent = parent                    # int32，根节点为-1
+        self.subtree_end = subtree_end          # int32
+        self.depth = depth                      # int32
+        self.local_position = local_position    # float64 (n, 3)
+        self.sprite_size = sprite_size          # float64 (n, 2)，无Sprite的节点为nan
+        self.flags = flags                      # uint8，HAS_SPRITE | RENDER_ENABLED
+        self.materials = materials              # 每个节点SpriteRenderer的材质guid元组
+        self.global_position = self._global_positions()
+        self._build_lookups()
+
+    def _build_lookups(self):
+        # 遍历时逐个访问的列，转为Python列表比逐个取NumPy标量快得多；与index一样不写入缓存
+        self.index = {node_id: i for i, node_id in enumerate(self.ids)}
+        self._subtree_end = self.subtree_end.tolist()
+        self._flags = self.flags.tolist()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('index', '_subtree_end', '_flags'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_lookups()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _global_positions(self) -> np.ndarray:
+        """父节点的深度总是小一层，按深度分组后逐层累加父节点的全局位置"""
+        result = self.local_position.copy()
+        order = np.argsort(self.depth, kind='stable')
+        level_starts = np.searchsorted(self.depth[order], np.arange(1, int(self.depth.max(initial=0)) + 1))
+        for start, end in zip(level_starts, list(level_starts[1:]) + [len(order)]):
+            level = order[start:end]
+            result[level] += result[self.parent[level]]
+        return result
+
+    def children(self, i: int):
+        child = i + 1
+        while child < self._subtree_end[i]:
+            yield child
+            child = self._subtree_end[child]
+
+    def has_sprite(self, i: int) -> bool:
+        return bool(self.flags[i] & HAS_SPRITE)
+
+    def render_enabled(self, i: int) -> bool:
+        return bool(self.flags[i] & RENDER_ENABLED)
+
+    def sprite_nodes(self) -> list[int]:
+        return np.flatnonzero(self.flags & HAS_SPRITE).tolist()
+
+    def material_guid(self, i: int) -> str:
+        materials = self.materials[i]
+        assert len(materials) == 1, f"Multiple or none materials found for SpriteRenderer in node {self.names[i]} (id: {self.ids[i]})"
+        return materials[0]
+
+    def traverse(self, action_list: dict, include_only=False) -> list[int]:
+        """
+        按composition动作（见assemble.parse_composition_actions）自根节点先序遍历，返回要合成的节点下标；
+        '-'跳过整棵子树，'+'包含该节点，'>'只取同名子节点并跳过其余子树
+        """
+        names = self.names
+        subtree_end = self._subtree_end
+        flags = self._flags
+        result = []
+        i = 0
+        end = subtree_end[0] if names else 0
+        while i < end:
+            action = action_list.get(names[i], None)
+            if action is not None:
+                if action == '-':
+                    # Exclude
+                    i = subtree_end[i]
+                    continue
+                elif action == '+':
+                    # Include
+                    if flags[i] & HAS_SPRITE:
+                        result.append(i)
+                else:
+                    # Exclusive '>' action
+                    child = next((child for child in self.children(i) if names[child] == action), None)
+                    if child is not None:
+                        assert flags[child] & HAS_SPRITE, f"Child node {names[child]} does not have a sprite"
+                        result.append(child)
+                        i = subtree_end[i]
+                        continue
+            elif flags[i] & HAS_SPRITE and flags[i] & RENDER_ENABLED and not include_only:
+                result.append(i)
+            i += 1
+        return result
+
+def flatten_tree(root: Node, node_map: dict) -> FlatTree:
+    """将build_tree的结果转为FlatTree，root为0号节点，不在其下的其他根节点（若有）依次排在后面"""
+    roots = [root] + [node for node in node_map.values() if node is not root and node.father not in node_map]
+    count = len(node_map)
+    ids, names, materials = [], [], []
+    parent = np.full(count, -1, dtype=np.int32)
+    subtree_end = np.zeros(count, dtype=np.int32)
+    depth = np.zeros(count, dtype=np.int32)
+    local_position = np.zeros((count, 3), dtype=np.float64)
+    sprite_size = np.full((count, 2), np.nan, dtype=np.float64)
+    flags = np.zeros(count, dtype=np.uint8)
+
+    # 迭代先序遍历，栈中的 (节点, 父节点下标) 出栈时编号；(None, 下标) 标记该节点子树结束
+    stack = [(node, -1) for node in reversed(roots)]
+    while stack:
+        node, parent_index = stack.pop()
+        if node is None:
+            subtree_end[parent_index] = len(ids)
+            continue
+        i = len(ids)
+        ids.append(node.id)
+        names.append(node.name)
+        parent[i] = parent_index
+        depth[i] = depth[parent_index] + 1 if parent_index >= 0 else 0
+        position = node._local_transform
+        local_position[i] = (position['x'], position['y'], position['z'])
+        if node.has_sprite():
+            flags[i] |= HAS_SPRITE
+            if node.render_enabled():
+                flags[i] |= RENDER_ENABLED
+            size = node.get_sprite_size()
+            sprite_size[i] = (size['x'], size['y'])
+            materials.append(tuple(material['guid'] for material in node.raw_sprite_renderer['SpriteRenderer']['m_Materials']))
+        else:
+            materials.append(())
+        stack.append((None, i))
+        stack.extend((node_map[child_id], i) for child_id in reversed(node.children))
+
+    count = len(ids)
+    return FlatTree(ids, names, parent[:count], subtree_end[:count], depth[:count],
+                    local_position[:count], sprite_size[:count], flags[:count], materials)
+
 def print_tree(node: Node, node_map: dict, depth=0):
     indent = '  ' * depth
     print(f"{indent}- {node.name} (id: {node.id})")
@@ -113,6 +262,7 @@ def main():
     parser.add_argument('-p', '--prefab', type=str, help='Prefab文件路径')
     args = parser.parse_args()
 
+    import assemble     # assemble依赖本模块，只在命令行入口中导入
     prefab_data = assemble.parse_prefab(args.prefab)
     root, node_map = build_tree(prefab_data)
     print_tree(root, node_map)
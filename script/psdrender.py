@@ -0,0 +1,339 @@
+import os
+import json
+import argparse
+import numpy as np
+from PIL import Image
+
+import blend
+import imgwriter
+import ptimer
+
+# 混合核：cb、cs为非预乘的颜色平面(3, h, w)，取值[0, 1]，B(Cb, Cs)写入out；
+# 大块临时数组的分配开销远高于运算本身，因此中间结果都写入scratch（blend._ScratchBuffers）中4号以后的暂存区
+def _multiply(cb, cs, out, scratch):
+    return np.multiply(cb, cs, out=out)
+
+def _screen(cb, cs, out, scratch):
+    # cb + cs - cb * cs
+    tmp = np.multiply(cb, cs, out=scratch.get(4, cb.shape))
+    np.add(cb, cs, out=out)
+    out -= tmp
+    return out
+
+def _overlay(cb, cs, out, scratch):
+    # 即以backdrop为条件的HardLight：cb <= 0.5时为 2 * cb * cs，否则为 1 - 2 * (1 - cb) * (1 - cs)
+    np.multiply(cb, cs, out=out)
+    out *= 2
+    high = np.subtract(1, cb, out=scratch.get(4, cb.shape))
+    high *= np.subtract(1, cs, out=scratch.get(5, cs.shape))
+    high *= -2
+    high += 1
+    np.copyto(out, high, where=cb > 0.5)
+    return out
+
+def _soft_light(cb, cs, out, scratch):
+    # Photoshop的Soft Light：cs <= 0.5时为 2 * cb * cs + cb^2 * (1 - 2 * cs)，否则为 2 * cb * (1 - cs) + sqrt(cb) * (2 * cs - 1)
+    tmp = scratch.get(4, cb.shape)
+    np.multiply(cs, -2, out=tmp)
+    tmp += 1
+    np.square(cb, out=out)
+    out *= tmp                          # cb^2 * (1 - 2 * cs)
+    high = np.sqrt(cb, out=scratch.get(5, cb.shape))
+    high *= tmp
+    high *= -1                          # sqrt(cb) * (2 * cs - 1)
+    tmp = np.multiply(cb, 2, out=tmp)
+    product = np.multiply(tmp, cs, out=scratch.get(6, cb.shape))
+    out += product                      # 低半段完成
+    high += tmp
+    high -= product                     # 2 * cb * (1 - cs) + ...
+    np.copyto(out, high, where=cs > 0.5)
+    return out
+
+BLEND_KERNELS = {
+    'NORMAL': None,
+    'MULTIPLY': _multiply,
+    'SCREEN': _screen,
+    'OVERLAY': _overlay,
+    'SOFT_LIGHT': _soft_light,
+}
+
+def _intersect(a: tuple, b: tuple) -> tuple|None:
+    left, top = max(a[0], b[0]), max(a[1], b[1])
+    right, bottom = min(a[2], b[2]), min(a[3], b[3])
+    if left >= right or top >= bottom:
+        return None
+    return left, top, right, bottom
+
+def _union(a: tuple|None, b: tuple|None) -> tuple|None:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+def _unpremultiply(surface_array, out, scratch, index: int):
+    """预乘的颜色除以alpha；alpha为0处颜色也为0，除以一个极小值即可，不必分支"""
+    alpha = np.maximum(surface_array[3], np.float32(1e-12), out=scratch.get(index, surface_array.shape[1:]))
+    return np.divide(surface_array[0:3], alpha, out=out)
+
+class Surface:
+    """预乘alpha的float32平面缓冲区(4, h, w)，覆盖画布上的rect=(left, top, right, bottom)"""
+    def __init__(self, rect: tuple, array: np.ndarray=None):
+        self.rect = rect
+        self.array = array if array is not None else np.zeros((4, rect[3] - rect[1], rect[2] - rect[0]), dtype=np.float32)
+
+    def view(self, rect: tuple) -> np.ndarray:
+        """rect（须在self.rect之内）对应的数组视图"""
+        left, top = self.rect[0:2]
+        return self.array[:, rect[1] - top:rect[3] - top, rect[0] - left:rect[2] - left]
+
+    def copy(self) -> 'Surface':
+        return Surface(self.rect, self.array.copy())
+
+def composite(dst: Surface, src: Surface, mode: str='NORMAL', opacity: float=1.0, clip: bool=False,
+              scratch: blend._ScratchBuffers=None):
+    """
+    按PSD的分离混合模式把src合成到dst上，只计算两者相交的矩形：
+        co = cs * (1 - ab) + cb * (1 - as) + as * ab * B(Cb, Cs)，ao = as + ab * (1 - as)
+    clip=True时为剪切蒙版组内的合成：dst的alpha不变，颜色按dst不透明处理，
+        co = cb * (1 - as) + as * ab * B(Cb, Cs)
+    """
+    rect = _intersect(dst.rect, src.rect)
+    if rect is None:
+        return
+    if scratch is None:
+        scratch = blend._ScratchBuffers()
+    d = dst.view(rect)
+    s = src.view(rect)
+    if opacity < 1.0:
+        s = np.multiply(s, np.float32(opacity), out=scratch.get(0, s.shape))
+    d_rgb, d_alpha = d[0:3], d[3]
+    s_rgb, s_alpha = s[0:3], s[3]
+    rgb_shape = d_rgb.shape
+
+    # blended为co中除cb * (1 - as)以外的部分
+    kernel = BLEND_KERNELS[mode]
+    if kernel is None:
+        # B = Cs 时 as * ab * B = cs * ab，非clip时与cs * (1 - ab)相加恰为cs
+        blended = np.multiply(s_rgb, d_alpha, out=scratch.get(1, rgb_shape)) if clip else s_rgb
+    else:
+        cb = _unpremultiply(d, scratch.get(2, rgb_shape), scratch, 7)
+        cs = _unpremultiply(s, scratch.get(3, rgb_shape), scratch, 7)
+        blended = kernel(cb, cs, scratch.get(1, rgb_shape), scratch)
+        blended *= np.multiply(s_alpha, d_alpha, out=scratch.get(7, d_alpha.shape))
+        if not clip:
+            blended += s_rgb
+            blended -= np.multiply(s_rgb, d_alpha, out=scratch.get(2, rgb_shape))
+
+    inverse_alpha = np.subtract(1, s_alpha, out=scratch.get(8, s_alpha.shape))
+    if not clip:
+        d_alpha *= inverse_alpha
+        d_alpha += s_alpha
+    d_rgb *= inverse_alpha
+    d_rgb += blended
+
+class ModelRenderer:
+    """
+    离线渲染extract_psd.py导出的model.json（与网页端读取的是同一份），按PSD的语义合成：
+    非PASS_THROUGH的图层组先在透明缓冲区内独立合成，再按组的混合模式与不透明度合成到下层；
+    PASS_THROUGH组的子图层直接合成到下层，组的不透明度在组内结果与下层之间插值；
+    clipping图层剪切到其下最近的非clipping同级节点（图层或图层组），
+    基底与其上的clipping图层先合成为一组，再按基底的混合模式与不透明度合成；基底隐藏时整组隐藏。
+    所有合成只在相关图层的包围盒内进行
+    """
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.model_dir = os.path.dirname(model_path)
+        with open(model_path, 'r', encoding='utf-8') as f:
+            self.model = json.load(f)
+        canvas_size = self.model["canvas_size"]
+        self.canvas_rect = (0, 0, canvas_size["width"], canvas_size["height"])
+        self._layers = {}       # 图片路径 -> (rect, uint8 RGBA)
+        self._paths = {}        # id(node) -> 从根开始以'/'连接的节点名
+        self._assign_paths(self.model["root"], "")
+        self._warned_modes = set()
+        self._scratch = blend._ScratchBuffers()    # composite的暂存区
+        self._sources = blend._ScratchBuffers()    # 转换后的图层：0号为正在合成的图层，1号为剪切蒙版组的基底图层
+
+    def _assign_paths(self, node, prefix):
+        for child in node.get("children", []):
+            path = f"{prefix}{child['name']}"
+            self._paths[id(child)] = path
+            self._assign_paths(child, path + '/')
+
+    @property
+    def node_paths(self) -> list[str]:
+        return list(self._paths.values())
+
+    def _layer_pixels(self, node) -> tuple:
+        """返回(rect, (h, w, 4)的uint8 RGBA)；按解码后的uint8缓存，float32副本约为其4倍大小"""
+        image_path = node["image"]
+        if image_path not in self._layers:
+            image_array = np.asarray(Image.open(os.path.join(self.model_dir, image_path)).convert('RGBA'))
+            x, y = node["offset"]["x"], node["offset"]["y"]
+            self._layers[image_path] = ((x, y, x + image_array.shape[1], y + image_array.shape[0]), image_array)
+        return self._layers[image_path]
+
+    def _layer_surface(self, node, slot: int=0) -> Surface:
+        """把图层转换为预乘alpha的float32，写入第slot号源暂存区（同一slot的结果在下次调用时失效）"""
+        rect, image_array = self._layer_pixels(node)
+        array = self._sources.get(slot, (4,) + image_array.shape[0:2])
+        np.multiply(image_array.transpose(2, 0, 1), np.float32(1 / 255), out=array)
+        array[0:3] *= array[3]
+        return Surface(rect, array)
+
+    def _mode(self, node) -> str:
+        mode = node.get("blend_mode", "NORMAL")
+        if mode not in BLEND_KERNELS:
+            if mode not in self._warned_modes:
+                self._warned_modes.add(mode)
+                print(f"\033[33mWarning: Unsupported blend mode {mode}, rendered as NORMAL\033[0m")
+            return 'NORMAL'
+        return mode
+
+    def _visible(self, node, visibility: dict) -> bool:
+        path = self._paths[id(node)]
+        if path in visibility:
+            return visibility[path]
+        return visibility.get(node["name"], node.get("visible", True))
+
+    def _bounds(self, node, visibility: dict, cache: dict) -> tuple|None:
+        """节点中可见部分在画布上的包围盒"""
+        key = id(node)
+        if key not in cache:
+            if node["type"] == "layer":
+                cache[key] = self._layer_pixels(node)[0]
+            else:
+                bounds = None
+                for child in node.get("children", []):
+                    if self._visible(child, visibility):
+                        bounds = _union(bounds, self._bounds(child, visibility, cache))
+                cache[key] = bounds
+        return cache[key]
+
+    def _isolated(self, node, visibility: dict, cache: dict, within: tuple) -> Surface|None:
+        """把节点单独合成到透明缓冲区，范围限制在within内"""
+        if node["type"] == "layer":
+            return self._layer_surface(node, slot=1)
+        bounds = self._bounds(node, visibility, cache)
+        rect = _intersect(bounds, within) if bounds is not None else None
+        if rect is None:
+            return None
+        surface = Surface(rect)
+        self._render_children(node["children"], surface, visibility, cache)
+        return surface
+
+    def _render_children(self, children: list, dst: Surface, visibility: dict, cache: dict):
+        index = 0
+        while index < len(children):
+            base = children[index]
+            index += 1
+            clips = []
+            while index < len(children) and children[index]["type"] == "layer" and children[index].get("clipping"):
+                clips.append(children[index])
+                index += 1
+            self._render_node(base, clips, dst, visibility, cache)
+
+    def _render_node(self, node, clips: list, dst: Surface, visibility: dict, cache: dict):
+        if not self._visible(node, visibility):
+            return
+        clips = [clip for clip in clips if self._visible(clip, visibility)]
+        mode = self._mode(node) if node.get("blend_mode") != "PASS_THROUGH" else "PASS_THROUGH"
+        opacity = node.get("opacity", 255) / 255
+
+        if node["type"] == "layer" and not clips:
+            composite(dst, self._layer_surface(node), mode, opacity, scratch=self._scratch)
+            return
+
+        if node["type"] == "group" and mode == "PASS_THROUGH" and not clips:
+            bounds = self._bounds(node, visibility, cache)
+            rect = _intersect(bounds, dst.rect) if bounds is not None else None
+            if rect is None:
+                return
+            if opacity >= 1.0:
+                self._render_children(node["children"], dst, visibility, cache)
+                return
+            backdrop = dst.view(rect).copy()
+            self._render_children(node["children"], dst, visibility, cache)
+            result = dst.view(rect)
+            result -= backdrop
+            result *= np.float32(opacity)
+            result += backdrop
+            return
+
+        # 独立合成：非PASS_THROUGH的组，或剪切蒙版组的基底（PASS_THROUGH组作为基底时也按独立组处理）
+        surface = self._isolated(node, visibility, cache, dst.rect)
+        if surface is None:
+            return
+        for clip in clips:
+            composite(surface, self._layer_surface(clip), self._mode(clip), clip.get("opacity", 255) / 255, clip=True,
+                      scratch=self._scratch)
+        composite(dst, surface, 'NORMAL' if mode == "PASS_THROUGH" else mode, opacity, scratch=self._scratch)
+
+    def render_array(self, visibility: dict=None) -> np.ndarray:
+        """
+        visibility: {节点名或'/'连接的节点路径: 是否显示}，未列出的节点使用model.json中的visible；
+        返回(height, width, 4)的uint8非预乘RGBA数组
+        """
+        visibility = visibility or {}
+        canvas = Surface(self.canvas_rect)
+        self._render_children(self.model["root"]["children"], canvas, visibility, {})
+        # 反预乘后就地量化，再转为交错存储
+        array = canvas.array
+        _unpremultiply(array, array[0:3], self._scratch, 0)
+        array *= 255
+        np.clip(array, 0, 255, out=array)
+        np.rint(array, out=array)
+        return np.ascontiguousarray(array.astype(np.uint8).transpose(1, 2, 0))
+
+    def render(self, visibility: dict=None) -> Image.Image:
+        return Image.fromarray(self.render_array(visibility))
+
+    def unknown_keys(self, visibility: dict) -> list[str]:
+        names = {path.rsplit('/', 1)[-1] for path in self._paths.values()}
+        return [key for key in visibility if key not in names and key not in self._paths.values()]
+
+def main():
+    parser = argparse.ArgumentParser(description="不依赖浏览器，按PSD混合语义渲染model.json模型")
+    parser.add_argument('-m', '--model', type=str, required=True, help='model.json路径')
+    parser.add_argument('-o', '--output', type=str, default='output', help='输出文件夹路径')
+    parser.add_argument('-n', '--name', type=str, default=None, help='单张渲染时的输出文件名，默认为角色名')
+    parser.add_argument('--show', type=str, nargs='+', default=[], help='要显示的节点名或节点路径（如 Alisa/Mask_Ref1/Body）')
+    parser.add_argument('--hide', type=str, nargs='+', default=[], help='要隐藏的节点名或节点路径')
+    parser.add_argument('-s', '--selections', type=str, default=None,
+                        help='批量渲染：JSON文件，内容为{输出文件名: {节点名或路径: 是否显示}}，--show/--hide作用于其中每一项')
+    parser.add_argument('--thumbnail', type=int, default=None, help='把结果缩小到不超过该边长')
+    parser.add_argument('--list', help='列出全部节点路径后退出', action='store_true')
+    imgwriter.add_arguments(parser)
+    args = parser.parse_args()
+
+    timer = ptimer.Timer()
+    renderer = ModelRenderer(args.model)
+    if args.list:
+        for path in renderer.node_paths:
+            print(path)
+        return
+
+    overrides = {key: True for key in args.show}
+    overrides.update({key: False for key in args.hide})
+    if args.selections is not None:
+        with open(args.selections, 'r', encoding='utf-8') as f:
+            selections = json.load(f)
+    else:
+        selections = {args.name or renderer.model.get("character", "model"): {}}
+
+    os.makedirs(args.output, exist_ok=True)
+    with imgwriter.ImageWriter(imgwriter.options_from_args(args)) as writer:
+        for output_name, visibility in selections.items():
+            visibility = {**visibility, **overrides}
+            for key in renderer.unknown_keys(visibility):
+                print(f"\033[33mWarning: No node named {key}\033[0m")
+            image = renderer.render(visibility)
+            if args.thumbnail:
+                image.thumbnail((args.thumbnail, args.thumbnail), Image.Resampling.LANCZOS)
+            output_path = writer.submit(image, os.path.join(args.output, f"{output_name}.png"))
+            timer.checkpoint(f"Rendering {output_name}")
+            print(f"\033[34mRendered model saved at {output_path}\033[0m")
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,12 @@
+import os
+import json
 import time
+import threading
+import tracemalloc
+from contextlib import nullcontext
+
+# 0: 只输出警告与结果，1: 输出各阶段耗时（默认），2: 另外输出每个图层的混合信息
+verbosity = 1
 
 class Timer:
     def __init__(self):
@@ -6,5 +14,201 @@ class Timer:
 
     def checkpoint(self, meg: str):
         end_time = time.time()
-        print(f"\033[32m{meg} took {(end_time - self.start_time):.2f} seconds.\033[0m")
+        elapsed = end_time - self.start_time
+        if verbosity >= 1:
+            print(f"\033[32m{meg} took {elapsed:.2f} seconds.\033[0m")
+        if _profiler is not None:
+            _profiler.record(meg, time.perf_counter() - elapsed, elapsed, {'checkpoint': True})
         self.start_time = end_time
+        return elapsed
+
+class _Span:
+    __slots__ = ('profiler', 'name', 'args', 'start')
+
+    def __init__(self, profiler: 'Profiler', name: str, args: dict):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.profiler._enter()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        depth = self.profiler._exit()
+        if self.profiler.trace_memory and depth == 0:
+            self.args['memory_peak'] = tracemalloc.get_traced_memory()[1]
+            self.profiler.memory_peak = max(self.profiler.memory_peak, self.args['memory_peak'])
+        self.profiler.record(self.name, self.start, duration, self.args, depth)
+
+class Profiler:
+    """
+    收集嵌套的计时区间（span）与计数器，可写为JSON lines或Chrome trace（chrome://tracing、Perfetto）；
+    时间戳取time.perf_counter()，同一台机器上的多个进程可以直接合并
+    trace_memory: 用tracemalloc记录每个顶层区间内的内存峰值
+    """
+    def __init__(self, trace_memory: bool=False):
+        self.trace_memory = trace_memory
+        self.events = []        # 已结束的区间：{name, start, duration, depth, pid, tid, args}
+        self.counters = {}
+        self.memory_peak = 0    # 各顶层区间内存峰值的最大值（字节）
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _enter(self):
+        depth = getattr(self._local, 'depth', 0)
+        if self.trace_memory and depth == 0:
+            tracemalloc.reset_peak()
+        self._local.depth = depth + 1
+
+    def _exit(self) -> int:
+        self._local.depth -= 1
+        return self._local.depth
+
+    def span(self, name: str, **args) -> _Span:
+        return _Span(self, name, args)
+
+    def record(self, name: str, start: float, duration: float, args: dict=None, depth: int=None):
+        event = {'name': name, 'start': start, 'duration': duration,
+                 'depth': getattr(self._local, 'depth', 0) if depth is None else depth,
+                 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args or {}}
+        with self._lock:
+            self.events.append(event)
+
+    def count(self, name: str, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def collect(self) -> tuple[list, dict]:
+        """取出并清空已收集的区间与计数器（子进程交回主进程合并）"""
+        with self._lock:
+            events, counters = self.events, self.counters
+            self.events, self.counters = [], {}
+        return events, counters
+
+    def merge(self, events: list, counters: dict):
+        with self._lock:
+            self.events.extend(events)
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            self.memory_peak = max([self.memory_peak] + [event['args'].get('memory_peak', 0) for event in events])
+
+    def summary(self) -> dict:
+        """按区间名汇总：{名称: {count, total, max}}，秒"""
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(event['name'], {'count': 0, 'total': 0.0, 'max': 0.0})
+            stage['count'] += 1
+            stage['total'] += event['duration']
+            stage['max'] = max(stage['max'], event['duration'])
+        return stages
+
+    def print_summary(self):
+        for name, stage in sorted(self.summary().items(), key=lambda item: -item[1]['total']):
+            print(f"\033[32m{name}: {stage['total']:.3f} seconds in total over {stage['count']} spans (max {stage['max']:.3f}).\033[0m")
+        for name, value in self.counters.items():
+            print(f"\033[32m{name}: {value}\033[0m")
+        if self.trace_memory:
+            print(f"\033[32mPeak traced memory: {self.memory_peak / 1024 / 1024:.1f} MB\033[0m")
+
+    def write_jsonl(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for event in sorted(self.events, key=lambda event: event['start']):
+                f.write(json.dumps({'type': 'span', **event}, ensure_ascii=False) + '\n')
+            for name, value in self.counters.items():
+                f.write(json.dumps({'type': 'counter', 'name': name, 'value': value}, ensure_ascii=False) + '\n')
+            summary = {'type': 'summary', 'stages': self.summary()}
+            if self.trace_memory:
+                summary['memory_peak'] = self.memory_peak
+            f.write(json.dumps(summary, ensure_ascii=False) + '\n')
+
+    def write_chrome_trace(self, path):
+        origin = min((event['start'] for event in self.events), default=0.0)
+        end = max((event['start'] + event['duration'] for event in self.events), default=origin)
+        trace_events = [{'name': event['name'], 'cat': event['name'].split('.')[0], 'ph': 'X',
+                         'ts': (event['start'] - origin) * 1e6, 'dur': event['duration'] * 1e6,
+                         'pid': event['pid'], 'tid': event['tid'], 'args': event['args']}
+                        for event in self.events]
+        # 计数器只有总量，作为结束时刻的一个采样
+        trace_events += [{'name': name, 'ph': 'C', 'ts': (end - origin) * 1e6, 'pid': os.getpid(), 'args': {name: value}}
+                         for name, value in self.counters.items()]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms',
+                       'otherData': {'memory_peak': self.memory_peak} if self.trace_memory else {}}, f, ensure_ascii=False)
+
+    def write(self, path, trace_format: str=None):
+        """trace_format: jsonl / chrome，默认按扩展名，.json为Chrome trace，其余为JSON lines"""
+        if trace_format is None:
+            trace_format = 'chrome' if path.endswith('.json') else 'jsonl'
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if trace_format == 'chrome':
+            self.write_chrome_trace(path)
+        else:
+            self.write_jsonl(path)
+
+# 当前进程的Profiler，为None时span与count不做任何记录
+_profiler = None
+_NULL_SPAN = nullcontext()
+
+def enable(trace_memory: bool=False) -> Profiler:
+    global _profiler
+    _profiler = Profiler(trace_memory)
+    return _profiler
+
+def disable() -> Profiler|None:
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None and profiler.trace_memory:
+        tracemalloc.stop()
+    return profiler
+
+def profiler() -> Profiler|None:
+    return _profiler
+
+def span(name: str, **args):
+    """with ptimer.span('plan'): ...，未启用Profiler时为空操作"""
+    if _profiler is None:
+        return _NULL_SPAN
+    return _Span(_profiler, name, args)
+
+def count(name: str, value=1):
+    if _profiler is not None:
+        _profiler.count(name, value)
+
+def state() -> tuple:
+    """当前进程的日志与采样设置，用于在子进程中通过restore重现"""
+    return verbosity, _profiler is not None, _profiler is not None and _profiler.trace_memory
+
+def restore(saved_state: tuple):
+    global verbosity
+    verbosity, profiling, trace_memory = saved_state
+    if profiling:
+        enable(trace_memory)
+
+def add_arguments(parser):
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='输出更详细的日志（-v：每个图层的混合信息）')
+    parser.add_argument('-q', '--quiet', help='不输出各阶段耗时', action='store_true')
+    parser.add_argument('--profile', type=str, help='记录各阶段的计时区间（解析、规划、裁剪、按混合模式的混合、编码）与计数器，写入该文件')
+    parser.add_argument('--profile-format', type=str, choices=['jsonl', 'chrome'], help='采样结果格式，默认按扩展名：.json为Chrome trace，其余为JSON lines')
+    parser.add_argument('--trace-memory', help='用tracemalloc记录各顶层区间的内存峰值（明显变慢）', action='store_true')
+
+def configure_from_args(args):
+    """按add_arguments添加的参数设置日志等级，需要时启用Profiler；args中缺少的参数取默认值"""
+    global verbosity
+    verbosity = 0 if getattr(args, 'quiet', False) else 1 + (getattr(args, 'verbose', 0) or 0)
+    if getattr(args, 'profile', None):
+        enable(getattr(args, 'trace_memory', False))
+
+def finish_from_args(args):
+    """写出configure_from_args启用的Profiler的结果"""
+    path = getattr(args, 'profile', None)
+    if path and _profiler is not None:
+        if verbosity >= 1:
+            _profiler.print_summary()
+        _profiler.write(path, getattr(args, 'profile_format', None))
+        print(f"\033[34mProfile saved to {path}\033[0m")
+    disable()
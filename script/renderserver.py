@@ -0,0 +1,255 @@
+import io
+import os
+import json
+import asyncio
+import argparse
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit, unquote
+
+import assemble
+import blend
+import breakup
+import charcache
+import expstruct
+import imgwriter
+
+DEFAULT_PORT = 8080
+DEFAULT_RESPONSE_CACHE_MB = 256
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'qoi': 'image/qoi',
+}
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+def find_export_dirs(root_dir) -> dict:
+    """
+    root_dir本身是解包目录时只提供这一个角色，否则提供其下每个解包目录；跳过骰子图集的解包目录，
+    角色名均取Prefab文件名（同charcache.Character.name）；返回{角色名: 解包目录}
+    """
+    if os.path.isdir(os.path.join(root_dir, 'ExportedProject')):
+        candidates = [root_dir]
+    else:
+        candidates = [os.path.join(root_dir, entry) for entry in sorted(os.listdir(root_dir))]
+    export_dirs = {}
+    for export_dir in candidates:
+        if not os.path.isdir(os.path.join(export_dir, 'ExportedProject')) or expstruct.is_dice_exportion(export_dir):
+            continue
+        name = os.path.basename(expstruct.analyse_export_structure(export_dir).prefab_path).split('.')[0]
+        if name in export_dirs:
+            print(f"\033[33mWarning: Character {name} in {export_dir} already provided by {export_dirs[name]}, skipping\033[0m")
+            continue
+        export_dirs[name] = export_dir
+    return export_dirs
+
+# 渲染在工作进程（或jobs<=1时的单个工作线程）中进行，每个角色的IncrementalRenderer常驻其中
+_worker_state = {}      # 解包目录 -> IncrementalRenderer
+
+def _worker_renderer(export_dir, engine: blend.BlendEngine, cache_bytes: int, raw_cache: bool) -> 'assemble.IncrementalRenderer':
+    if export_dir not in _worker_state:
+        character = charcache.load_character(export_dir)
+        cache_dir = character.export_struct.cache_dir if raw_cache else None
+        image_cropper = breakup.ImageCropper(character.export_struct.texture_path, cache_dir)
+        _worker_state[export_dir] = assemble.IncrementalRenderer(character, engine, cache_bytes, image_cropper)
+    return _worker_state[export_dir]
+
+def _render_task(export_dir, actions: tuple, engine: blend.BlendEngine, cache_bytes: int, raw_cache: bool,
+                 writer_options: imgwriter.WriterOptions) -> bytes:
+    """actions: 规范化的动作（见assemble.CompositionTable.normalized_actions）"""
+    renderer = _worker_renderer(export_dir, engine, cache_bytes, raw_cache)
+    image = renderer.render_actions(actions)
+    buffer = io.BytesIO()
+    imgwriter.save_image(image, buffer, writer_options)
+    return buffer.getvalue()
+
+class RenderService:
+    """
+    常驻的立绘渲染服务：角色数据与纹理常驻内存；
+    同一角色相同（规范化后的）动作列表的并发请求只渲染一次，结果按字节上限做LRU缓存；
+    cache_bytes为整个服务的前缀缓存上限，平均分给各角色与各合成进程
+    """
+    def __init__(self, export_dirs: dict, engine: blend.BlendEngine=blend.BlendEngine.FLOAT32, jobs: int=1,
+                 cache_bytes: int=None, response_cache_bytes: int=DEFAULT_RESPONSE_CACHE_MB * 1024 * 1024, raw_cache: bool=True,
+                 writer_options: imgwriter.WriterOptions=imgwriter.WriterOptions()):
+        self.export_dirs = export_dirs
+        self.engine = engine
+        self.cache_bytes = cache_bytes if cache_bytes is not None else assemble.DEFAULT_PREFIX_CACHE_MB * 1024 * 1024
+        # 任一合成进程都可能为每个角色各持有一个IncrementalRenderer
+        self.renderer_cache_bytes = self.cache_bytes // (max(len(export_dirs), 1) * max(jobs, 1))
+        self.response_cache_bytes = response_cache_bytes
+        self.raw_cache = raw_cache
+        self.writer_options = writer_options
+        self.content_type = CONTENT_TYPES[writer_options.image_format]
+        # 合成是CPU密集的：jobs>1时使用进程池，否则在一个工作线程中进行（不阻塞事件循环）；
+        # 服务进程中已有事件循环与线程，fork出的子进程可能继承被占用的锁，因此以spawn方式启动
+        if jobs > 1:
+            self._executor = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._characters = {}               # 角色名 -> Character（用于规范化请求）
+        self._character_loads = {}          # 角色名 -> 正在读取的Future
+        self._responses = OrderedDict()     # (角色名, 动作) -> 编码后的图像，LRU顺序
+        self._response_bytes = 0
+        self._in_flight = {}                # (角色名, 动作) -> 正在渲染的Future
+        self.stats = {'requests': 0, 'hits': 0, 'coalesced': 0, 'renders': 0, 'errors': 0}
+
+    async def character(self, name: str) -> 'charcache.Character':
+        if name not in self.export_dirs:
+            raise HTTPError(404, f"Unknown character: {name}")
+        if name not in self._characters:
+            if name not in self._character_loads:
+                loop = asyncio.get_running_loop()
+                self._character_loads[name] = loop.run_in_executor(None, charcache.load_character, self.export_dirs[name])
+            try:
+                self._characters[name] = await self._character_loads[name]
+            finally:
+                self._character_loads.pop(name, None)
+        return self._characters[name]
+
+    def _store_response(self, key, data: bytes):
+        if self.response_cache_bytes <= 0 or len(data) > self.response_cache_bytes:
+            return
+        self._responses[key] = data
+        self._response_bytes += len(data)
+        while self._response_bytes > self.response_cache_bytes:
+            _key, evicted = self._responses.popitem(last=False)
+            self._response_bytes -= len(evicted)
+
+    async def render(self, name: str, composition_keys: list[str]) -> tuple[bytes, str]:
+        """返回(图像数据, 来源)，来源为hit、coalesced或render"""
+        self.stats['requests'] += 1
+        character = await self.character(name)
+        try:
+            actions = character.composition.normalized_actions(composition_keys)
+        except (AssertionError, ValueError) as e:
+            raise HTTPError(400, f"Invalid composition keys: {e}")
+        key = (name, actions)
+
+        if key in self._responses:
+            self._responses.move_to_end(key)
+            self.stats['hits'] += 1
+            return self._responses[key], 'hit'
+        if key in self._in_flight:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(self._in_flight[key]), 'coalesced'
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, _render_task, self.export_dirs[name], actions,
+                                      self.engine, self.renderer_cache_bytes, self.raw_cache, self.writer_options)
+        self._in_flight[key] = future
+        self.stats['renders'] += 1
+        try:
+            data = await asyncio.shield(future)
+        finally:
+            self._in_flight.pop(key, None)
+        self._store_response(key, data)
+        return data, 'render'
+
+    def status(self) -> dict:
+        return {**self.stats, 'cached_responses': len(self._responses), 'cached_bytes': self._response_bytes,
+                'in_flight': len(self._in_flight), 'characters_loaded': sorted(self._characters)}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def handle(self, method: str, target: str) -> tuple[int, str, bytes, dict]:
+        """处理一个请求，返回(状态码, Content-Type, 响应体, 额外的响应头)"""
+        if method != 'GET':
+            raise HTTPError(405, f"Method not allowed: {method}")
+        url = urlsplit(target)
+        path = [unquote(part) for part in url.path.strip('/').split('/')]
+        if path == ['characters']:
+            return 200, 'application/json', json.dumps(list(self.export_dirs), ensure_ascii=False).encode(), {}
+        if path == ['stats']:
+            return 200, 'application/json', json.dumps(self.status(), ensure_ascii=False).encode(), {}
+        if len(path) == 2 and path[0] == 'render':
+            # keys=A,B,C，也可以重复多次keys=A&keys=B；不用parse_qs，以免compositionMap写法中的'+'被解码为空格
+            values = [unquote(value) for name, _, value in (part.partition('=') for part in url.query.split('&')) if name == 'keys']
+            composition_keys = [key for value in values for key in value.split(',') if key]
+            data, source = await self.render(path[1], composition_keys)
+            return 200, self.content_type, data, {'X-Render-Cache': source}
+        raise HTTPError(404, f"Not found: {url.path}")
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """最小的HTTP/1.1实现：每个连接处理一个请求后关闭"""
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass    # 忽略请求头
+            try:
+                method, target, _version = request_line.split(' ')
+                status, content_type, body, headers = await self.handle(method, target)
+            except HTTPError as e:
+                self.stats['errors'] += 1
+                status, content_type, body, headers = e.status, 'application/json', json.dumps({'error': str(e)}).encode(), {}
+            except ValueError:
+                self.stats['errors'] += 1
+                status, content_type, body, headers = 400, 'application/json', b'{"error": "Bad request"}', {}
+            except Exception as e:
+                self.stats['errors'] += 1
+                print(f"\033[33mWarning: Request {request_line} failed: {e!r}\033[0m")
+                status, content_type, body, headers = 500, 'application/json', json.dumps({'error': repr(e)}).encode(), {}
+
+            head = [f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}", f"Content-Type: {content_type}",
+                    f"Content-Length: {len(body)}", "Connection: close"]
+            head.extend(f"{name}: {value}" for name, value in headers.items())
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+async def serve_forever(service: RenderService, host: str, port: int, ready: asyncio.Event=None):
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    async with server:
+        address = server.sockets[0].getsockname()
+        print(f"\033[34mServing {len(service.export_dirs)} characters on http://{address[0]}:{address[1]}/render/<character>?keys=...\033[0m")
+        if ready is not None:
+            ready.set()
+        await server.serve_forever()
+
+def add_arguments(parser):
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='渲染服务监听的地址')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='渲染服务监听的端口')
+    parser.add_argument('--response-cache-mb', type=int, default=DEFAULT_RESPONSE_CACHE_MB, help='渲染结果缓存的内存上限（MB），0为不缓存')
+
+def main(config=None):
+    parser = argparse.ArgumentParser(description="常驻的立绘渲染HTTP服务")
+    parser.add_argument('-d', '--dir', type=str, required=True, help='解包文件路径，或包含多个角色解包目录的文件夹')
+    parser.add_argument('-e', '--engine', type=str, choices=['float32', 'uint8'], default='float32', help='图层混合引擎')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='合成进程数，1为在服务进程的工作线程中合成')
+    parser.add_argument('--cache-mb', type=int, default=assemble.DEFAULT_PREFIX_CACHE_MB, help='共同图层前缀缓存的总内存上限（MB），平均分给各角色与各合成进程')
+    parser.add_argument('--no-raw-cache', help='不使用（也不写入）纹理原始像素缓存', action='store_true')
+    add_arguments(parser)
+    imgwriter.add_arguments(parser)
+    args = config if config is not None else parser.parse_args()
+
+    export_dirs = find_export_dirs(args.dir)
+    if not export_dirs:
+        parser.error(f"No character export directory found in {args.dir}")
+    service = RenderService(export_dirs,
+                            engine=blend.BlendEngine[getattr(args, 'engine', 'float32').upper()],
+                            jobs=getattr(args, 'jobs', 1) or 1,
+                            cache_bytes=getattr(args, 'cache_mb', assemble.DEFAULT_PREFIX_CACHE_MB) * 1024 * 1024,
+                            response_cache_bytes=args.response_cache_mb * 1024 * 1024,
+                            raw_cache=not getattr(args, 'no_raw_cache', False),
+                            writer_options=imgwriter.options_from_args(args))
+    try:
+        asyncio.run(serve_forever(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+if __name__ == "__main__":
+    main()
@@ -7,21 +7,55 @@ import breakup
 import config as cfg
 import expstruct
 import diceasm
+import imgwriter
+import ptimer
+import renderserver
 
 class Dummy:
     pass
 
+def copy_writer_arguments(args, parsed_config):
+    """把图像输出相关的命令行参数传给子脚本"""
+    for name in ('format', 'compress_level', 'png_strategy', 'writer_threads'):
+        setattr(parsed_config, name, getattr(args, name))
+
+def copy_profile_arguments(args, parsed_config):
+    """把日志等级与性能采样相关的命令行参数传给子脚本"""
+    for name in ('verbose', 'quiet', 'profile', 'profile_format', 'trace_memory'):
+        setattr(parsed_config, name, getattr(args, name))
+
 def main():
     parser = argparse.ArgumentParser(description="运行拆分和重组脚本")
     parser.add_argument('-g', '--genconfig', help='运行config.py自动生成配置文件', action='store_true')
     parser.add_argument('-a', '--assemble', help='运行assemble.py', action='store_true')
     parser.add_argument('-b', '--breakup', help='运行breakup.py', action='store_true')
+    parser.add_argument('--enumerate', help='生成配置文件时枚举compositionMap各组键的全部组合（图层相同的组合只合成一次）', action='store_true')
+    parser.add_argument('-s', '--serve', help='启动常驻的立绘渲染HTTP服务（-d可为包含多个角色解包目录的文件夹）', action='store_true')
 
     parser.add_argument('-c', '--config', type=str, help='配置文件路径')
     parser.add_argument('-d', '--dir', type=str, help='解包文件路径，应为ExportedProject的上级目录')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='合成立绘（或重组切块Sprite）时使用的进程数')
+    parser.add_argument('--cache-mb', type=int, default=512, help='共同图层前缀缓存的内存上限（MB），0为不缓存')
+    parser.add_argument('--no-raw-cache', help='不使用（也不写入）纹理原始像素缓存', action='store_true')
+    renderserver.add_arguments(parser)
+    imgwriter.add_arguments(parser)
+    ptimer.add_arguments(parser)
 
     args = parser.parse_args()
 
+    if args.serve:
+        arglist = Dummy()
+        arglist.dir = args.dir
+        arglist.jobs = args.jobs
+        arglist.cache_mb = args.cache_mb
+        arglist.no_raw_cache = args.no_raw_cache
+        arglist.host = args.host
+        arglist.port = args.port
+        arglist.response_cache_mb = args.response_cache_mb
+        copy_writer_arguments(args, arglist)
+        renderserver.main(arglist)
+        return
+
     if expstruct.is_dice_exportion(args.dir):
         print("\033[34mAnalysing dice sprite exportion structure\033[0m")
         export_struct = expstruct.analyse_dice_exportion(args.dir)
@@ -29,6 +63,9 @@ def main():
         arglist.output = os.path.join('output', export_struct.name)
         arglist.texture = export_struct.texture_path
         arglist.file = export_struct.sprite_path_list
+        arglist.cache_dir = None if args.no_raw_cache else expstruct.get_cache_dir(args.dir)
+        arglist.jobs = args.jobs
+        copy_writer_arguments(args, arglist)
         diceasm.main(arglist)
         return
 
@@ -45,6 +82,7 @@ def main():
         arglist = Dummy()
         arglist.dir = args.dir
         arglist.output = './configs'
+        arglist.enumerate = args.enumerate
         json_path = cfg.main(arglist)
 
     with open(json_path, 'r', encoding='utf-8') as f:
@@ -58,6 +96,8 @@ def main():
         parsed_config = Dummy()
         parsed_config.output = config['output_dir_sprite']
         parsed_config.dir = config['export_dir']
+        parsed_config.no_raw_cache = args.no_raw_cache
+        copy_writer_arguments(args, parsed_config)
         # parsed_config
         breakup.main(parsed_config)
 
@@ -70,6 +110,12 @@ def main():
         # parsed_config.output = config['output_dir_figure']
         # for composition in config['composite_keys_list']:
         parsed_config.compositionKeys = config['composite_keys_list']
+        parsed_config.compositionManifest = config.get('composite_manifest')
+        parsed_config.jobs = args.jobs
+        parsed_config.cache_mb = args.cache_mb
+        parsed_config.no_raw_cache = args.no_raw_cache
+        copy_writer_arguments(args, parsed_config)
+        copy_profile_arguments(args, parsed_config)
         # print(f"parsed_config: {parsed_config}")
         assemble.main(parsed_config)
 
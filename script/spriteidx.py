@@ -0,0 +1,139 @@
+import os
+import re
+import json
+import argparse
+import yaml
+
+import expstruct
+
+INDEX_VERSION = 1
+INDEX_FILE_NAME = 'sprite_index.json'
+
+_FLOW_ITEM_PATTERN = re.compile(r'(\w+):\s*([^,}]+)')
+
+def _parse_scalar(text: str):
+    text = text.strip()
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def _parse_flow_mapping(text: str):
+    """解析形如 {x: 0.5, y: 0.5} 的单行映射"""
+    return {key: _parse_scalar(value) for key, value in _FLOW_ITEM_PATTERN.findall(text)}
+
+def _make_entry(m_rect: dict, pivot: dict, pixels_to_units):
+    rect = {key: m_rect[key] for key in ('x', 'y', 'width', 'height')}
+    return {
+        'rect': rect,
+        'pivot': {'x': pivot['x'], 'y': pivot['y']},
+        'size': {'x': rect['width'] / pixels_to_units, 'y': rect['height'] / pixels_to_units},
+    }
+
+def _scan_sprite_asset(sprite_path):
+    """
+    逐行扫描Sprite资产，只读取m_Rect、m_PixelsToUnits与m_Pivot，读到后立即停止，
+    无法识别时返回None
+    """
+    m_rect = {}
+    pixels_to_units = None
+    pivot = None
+    in_rect = False
+    with open(sprite_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            stripped = line.strip()
+            if in_rect:
+                if line.startswith('    ') and ':' in stripped:
+                    key, value = stripped.split(':', 1)
+                    m_rect[key] = _parse_scalar(value)
+                    continue
+                in_rect = False
+            if stripped == 'm_Rect:':
+                in_rect = True
+            elif stripped.startswith('m_PixelsToUnits:'):
+                pixels_to_units = _parse_scalar(stripped.split(':', 1)[1])
+            elif stripped.startswith('m_Pivot:'):
+                pivot = _parse_flow_mapping(stripped.split(':', 1)[1])
+            if m_rect and pixels_to_units is not None and pivot is not None:
+                break
+
+    if not all(key in m_rect for key in ('x', 'y', 'width', 'height')):
+        return None
+    if pixels_to_units is None or pivot is None or 'x' not in pivot or 'y' not in pivot:
+        return None
+    return _make_entry(m_rect, pivot, pixels_to_units)
+
+def _load_sprite_asset(sprite_path):
+    """完整YAML解析，作为扫描失败时的回退"""
+    with open(sprite_path, 'r', encoding='utf-8') as f:
+        content = ''.join(f.readlines()[3:])    # 去掉前3行
+    sprite = yaml.safe_load(content).get('Sprite', {})
+    return _make_entry(sprite['m_Rect'], sprite['m_Pivot'], sprite['m_PixelsToUnits'])
+
+def read_sprite_entry(sprite_path):
+    try:
+        entry = _scan_sprite_asset(sprite_path)
+    except ValueError:
+        entry = None
+    if entry is None:
+        entry = _load_sprite_asset(sprite_path)
+    return entry
+
+class SpriteIndex:
+    """Sprite名 -> rect/pivot/size，按导出目录构建一次"""
+    def __init__(self, entries: dict):
+        self.entries = entries
+
+    def get_rect(self, name: str) -> dict:
+        return self.entries[name]['rect']
+
+    def get_pivot(self, name: str) -> dict:
+        return self.entries[name]['pivot']
+
+    def get_size(self, name: str) -> dict:
+        return self.entries[name]['size']
+
+def load_sprite_index(export_struct: expstruct.ExportStructure) -> SpriteIndex:
+    """读取缓存的Sprite索引，只重新扫描mtime变化的资产"""
+    cache_path = os.path.join(export_struct.cache_dir, INDEX_FILE_NAME)
+    cached = {}
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                cached = data['sprites']
+        except (OSError, ValueError, KeyError):
+            cached = {}
+
+    entries = {}
+    changed = len(cached) != len(export_struct.sprite_path)
+    for name, path in export_struct.sprite_path.items():
+        mtime = os.stat(path).st_mtime_ns
+        entry = cached.get(name)
+        if entry is None or entry['path'] != path or entry['mtime'] != mtime:
+            entry = read_sprite_entry(path)
+            entry['path'] = path
+            entry['mtime'] = mtime
+            changed = True
+        entries[name] = entry
+
+    if changed:
+        os.makedirs(export_struct.cache_dir, exist_ok=True)
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'sprites': entries}, f)
+
+    return SpriteIndex(entries)
+
+def main():
+    parser = argparse.ArgumentParser(description="构建Sprite元数据索引")
+    parser.add_argument('-d', '--dir', type=str, help='解包文件路径，应为ExportedProject的上级目录')
+    args = parser.parse_args()
+
+    export_struct = expstruct.analyse_export_structure(args.dir)
+    sprite_index = load_sprite_index(export_struct)
+    for name, entry in sprite_index.entries.items():
+        print(f"{name}: rect={entry['rect']}, pivot={entry['pivot']}, size={entry['size']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import os
+import json
+import argparse
+from dataclasses import dataclass
+import numpy as np
+from PIL import Image
+
+import imgwriter
+
+DEFAULT_PAGE_SIZE = 4096
+DEFAULT_PADDING = 2
+
+@dataclass
+class PackedSprite:
+    """
+    一个打包后的组件：page页上(x, y)处的trimmed图像，
+    对应原图(source_width, source_height)中以(trim_x, trim_y)为左上角的区域
+    """
+    name: str
+    image_array: np.ndarray
+    source_width: int
+    source_height: int
+    trim_x: int = 0
+    trim_y: int = 0
+    page: int = -1
+    x: int = 0
+    y: int = 0
+
+    @property
+    def width(self) -> int:
+        return self.image_array.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.image_array.shape[0]
+
+def trim_sprite(image_array: np.ndarray):
+    """去掉四周完全透明的行列，返回(trimmed, (left, top))；全透明时保留1x1"""
+    if image_array.ndim != 3 or image_array.shape[2] != 4:
+        return image_array, (0, 0)
+    alpha = image_array[:, :, 3]
+    rows = np.flatnonzero(alpha.any(axis=1))
+    if len(rows) == 0:
+        return image_array[0:1, 0:1], (0, 0)
+    cols = np.flatnonzero(alpha.any(axis=0))
+    top, bottom = rows[0], rows[-1] + 1
+    left, right = cols[0], cols[-1] + 1
+    return image_array[top:bottom, left:right], (int(left), int(top))
+
+class SkylinePacker:
+    """Skyline Bottom-Left装箱：维护各列已占用的高度轮廓，每次选放置后顶边最低（其次最靠左）的位置"""
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.skyline = [[0, 0, width]]   # [x, y, width]，按x排列
+        self.used_width = 0
+        self.used_height = 0
+
+    def _fit(self, index: int, width: int, height: int):
+        """矩形左边对齐第index段时的放置高度，放不下时返回None"""
+        x = self.skyline[index][0]
+        if x + width > self.width:
+            return None
+        y = 0
+        remaining = width
+        while remaining > 0:
+            if index >= len(self.skyline):
+                return None
+            y = max(y, self.skyline[index][1])
+            if y + height > self.height:
+                return None
+            remaining -= self.skyline[index][2]
+            index += 1
+        return y
+
+    def insert(self, width: int, height: int):
+        """放入width x height的矩形，返回左上角(x, y)，放不下时返回None"""
+        best = None
+        for index in range(len(self.skyline)):
+            y = self._fit(index, width, height)
+            if y is not None and (best is None or (y + height, self.skyline[index][0]) < best[0]):
+                best = ((y + height, self.skyline[index][0]), index, y)
+        if best is None:
+            return None
+        _, index, y = best
+        x = self.skyline[index][0]
+
+        # 新段覆盖[x, x + width)，之后被覆盖的段截短或删除，再合并等高的相邻段
+        self.skyline.insert(index, [x, y + height, width])
+        i = index + 1
+        while i < len(self.skyline):
+            segment = self.skyline[i]
+            overlap = x + width - segment[0]
+            if overlap <= 0:
+                break
+            if overlap >= segment[2]:
+                del self.skyline[i]
+            else:
+                segment[0] += overlap
+                segment[2] -= overlap
+                break
+        i = 0
+        while i < len(self.skyline) - 1:
+            if self.skyline[i][1] == self.skyline[i + 1][1]:
+                self.skyline[i][2] += self.skyline[i + 1][2]
+                del self.skyline[i + 1]
+            else:
+                i += 1
+
+        self.used_width = max(self.used_width, x + width)
+        self.used_height = max(self.used_height, y + height)
+        return x, y
+
+def pack_sprites(sprites: list[PackedSprite], page_size: int=DEFAULT_PAGE_SIZE, padding: int=DEFAULT_PADDING) -> list[tuple[int, int]]:
+    """
+    按高度从大到小依次装入page_size见方的页面，放不下时新开一页；
+    就地填写每个组件的page/x/y，返回各页实际使用的(width, height)。
+    超过页面尺寸的组件单独占一页
+    """
+    packers = []
+    page_sizes = []
+    for sprite in sorted(sprites, key=lambda s: (s.height, s.width), reverse=True):
+        # 每个矩形向右下各扩展padding，页面也扩展padding，使页面边缘无需留白
+        width, height = sprite.width + padding, sprite.height + padding
+        for page, packer in enumerate(packers):
+            if packer is None:
+                continue
+            position = packer.insert(width, height)
+            if position is not None:
+                break
+        else:
+            if sprite.width > page_size or sprite.height > page_size:
+                packers.append(None)
+                page = len(packers) - 1
+                position = (0, 0)
+                page_sizes.append((sprite.width, sprite.height))
+            else:
+                packers.append(SkylinePacker(page_size + padding, page_size + padding))
+                page_sizes.append(None)
+                page = len(packers) - 1
+                position = packers[page].insert(width, height)
+        sprite.page = page
+        sprite.x, sprite.y = position
+
+    return [size if packer is None else (packer.used_width - padding, packer.used_height - padding)
+            for packer, size in zip(packers, page_sizes)]
+
+def render_pages(sprites: list[PackedSprite], page_sizes: list[tuple[int, int]]) -> list[np.ndarray]:
+    pages = [np.zeros((height, width, 4), dtype=np.uint8) for width, height in page_sizes]
+    for sprite in sprites:
+        pages[sprite.page][sprite.y:sprite.y + sprite.height, sprite.x:sprite.x + sprite.width] = sprite.image_array
+    return pages
+
+def build_sheet_json(sprites: list[PackedSprite], page: int, page_size: tuple[int, int], image_name: str, related: list[str]) -> dict:
+    """PixiJS可直接加载的TexturePacker JSON Hash格式"""
+    frames = {}
+    for sprite in sprites:
+        if sprite.page != page:
+            continue
+        trimmed = (sprite.width, sprite.height) != (sprite.source_width, sprite.source_height)
+        frames[f"{sprite.name}.png"] = {
+            'frame': {'x': sprite.x, 'y': sprite.y, 'w': sprite.width, 'h': sprite.height},
+            'rotated': False,
+            'trimmed': trimmed,
+            'spriteSourceSize': {'x': sprite.trim_x, 'y': sprite.trim_y, 'w': sprite.width, 'h': sprite.height},
+            'sourceSize': {'w': sprite.source_width, 'h': sprite.source_height},
+        }
+    meta = {
+        'app': 'live_manosaba spritepack',
+        'version': '1.0',
+        'image': image_name,
+        'format': 'RGBA8888',
+        'size': {'w': page_size[0], 'h': page_size[1]},
+        'scale': '1',
+    }
+    if related:
+        meta['related_multi_packs'] = related
+    return {'frames': frames, 'meta': meta}
+
+def write_sheets(images: dict, output_dir, sheet_name: str, writer: imgwriter.ImageWriter,
+                 page_size: int=DEFAULT_PAGE_SIZE, padding: int=DEFAULT_PADDING, trim: bool=True) -> list[str]:
+    """
+    images: {组件名: RGBA数组}；打包为若干页，每页写出一张图像与一个同名JSON，返回JSON路径列表
+    """
+    sprites = []
+    for name, image_array in images.items():
+        source_height, source_width = image_array.shape[0:2]
+        trimmed, (trim_x, trim_y) = trim_sprite(image_array) if trim else (image_array, (0, 0))
+        sprites.append(PackedSprite(name, trimmed, source_width, source_height, trim_x, trim_y))
+
+    page_sizes = pack_sprites(sprites, page_size, padding)
+    pages = render_pages(sprites, page_sizes)
+
+    os.makedirs(output_dir, exist_ok=True)
+    json_names = [f"{sheet_name}-{page}.json" for page in range(len(pages))]
+    json_paths = []
+    for page, page_array in enumerate(pages):
+        image_path = writer.submit(Image.fromarray(page_array), os.path.join(output_dir, f"{sheet_name}-{page}.png"))
+        sheet = build_sheet_json(sprites, page, page_sizes[page], os.path.basename(image_path),
+                                 [name for name in json_names if name != json_names[page]])
+        json_path = os.path.join(output_dir, json_names[page])
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(sheet, f, ensure_ascii=False, indent=1)
+        json_paths.append(json_path)
+        print(f"\033[34mSprite sheet page {page} ({page_sizes[page][0]}x{page_sizes[page][1]}, {len(sheet['frames'])} sprites) saved to {json_path}\033[0m")
+    return json_paths
+
+def main():
+    parser = argparse.ArgumentParser(description="把一个目录中的PNG组件裁边并打包为精灵图集")
+    parser.add_argument('-i', '--input', type=str, required=True, help='组件PNG所在目录')
+    parser.add_argument('-o', '--output', type=str, default='output', help='输出文件夹路径')
+    parser.add_argument('-n', '--name', type=str, default='sheet', help='图集文件名前缀')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE, help='图集页面的最大边长')
+    parser.add_argument('--padding', type=int, default=DEFAULT_PADDING, help='组件之间的间距（像素）')
+    parser.add_argument('--no-trim', help='不裁掉透明边缘', action='store_true')
+    imgwriter.add_arguments(parser)
+    args = parser.parse_args()
+
+    images = {}
+    for entry in sorted(os.listdir(args.input)):
+        if entry.endswith('.png'):
+            images[entry[:-len('.png')]] = np.array(Image.open(os.path.join(args.input, entry)).convert('RGBA'))
+    with imgwriter.ImageWriter(imgwriter.options_from_args(args)) as writer:
+        write_sheets(images, args.output, args.name, writer, args.page_size, args.padding, not args.no_trim)
+
+if __name__ == "__main__":
+    main()